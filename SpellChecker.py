@@ -17,17 +17,34 @@
 # importing the packages
 import codecs
 import copy
+import hashlib
+import json
 import random
 
 import pandas as pd
 import numpy as np
 import tensorflow as tf
 import os
+import sys
+import shutil
+import filecmp
+import tempfile
+import itertools
+import threading
+import queue
+import urllib.request
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 from os import listdir
 from os.path import isfile, join
-from collections import namedtuple
+from collections import namedtuple, deque, Counter, OrderedDict
+from concurrent.futures import Future
+from glob import glob
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
 from tensorflow.python.layers.core import Dense
 from tensorflow.python.ops.rnn_cell_impl import _zero_state_tensors
+from tensorflow.python.util import nest
 import time
 import re
 from sklearn.model_selection import train_test_split
@@ -49,34 +66,51 @@ def load_book(path):
 # In[3]:
 
 
-# Collect all of the book file names
-path = './books/text/'
-book_files = [f for f in listdir(path) if isfile(join(path, f))]
-book_files = book_files[1:]
+# Collect all of the book file names. With read_epubs the books are read straight from their epubs, 
+# without writing the text files of epub2txt.py first
+read_epubs = False
+if read_epubs:
+    import epub2txt
+    path = './books/raw/'
+    extension = '.epub'
+else:
+    path = './books/text/'
+    extension = '.txt'
+# Sort the names and keep only the books, skipping hidden files such as .DS_Store, downloads still in progress 
+# and anything else kept next to them, so the same books are always read in the same order
+book_files = sorted([f for f in listdir(path) 
+                     if isfile(join(path, f)) and not f.startswith('.') and f.lower().endswith(extension)])
 
 
 # In[4]:
 
 
-# Load the books using the file names
-books = []
-for book in book_files:
-    books.append(load_book(path+book))
+# The books are read one line at a time by the cells below, so only their paths are kept
+book_paths = [path+book for book in book_files]
 
 
-# In[5]:
-
-
-# Getting number of words in each book 
-for i in range(len(books)):
-    print("The number of {} words in book of named {}.".format(len(books[i].split()), book_files[i]))
+# Read a book one line at a time. An epub is converted as it is read, into the same lines as its text file.
+def iter_book_lines(book_path):
+    if book_path.endswith('.epub'):
+        rest = ''
+        for text in epub2txt.epub2txt(book_path).iterText():
+            lines = (rest + text).split('\n')
+            for line in lines[:-1]:
+                yield line + '\n'
+            rest = lines[-1]
+        if rest:
+            yield rest
+    else:
+        with open(book_path, encoding='utf_8') as f:
+            for line in f:
+                yield line
 
 
 # In[6]:
 
 
-# print 500 words of 4th books 
-books[4][:500]
+# print 500 characters of the first book
+print("".join(itertools.islice(iter_book_lines(book_paths[0]), 50))[:500])
 
 
 # ### Data Preprocessing
@@ -84,8 +118,33 @@ books[4][:500]
 # In[7]:
 
 
-# Method to clean the data
+# Characters removed by clean_text
+clean_text_removed = re.compile(r'[{}@_*>()\\#%+=\[\]]')
+
+# The escaped quotes handled by clean_text, in the order they are replaced
+clean_text_quotes = [('\'92t', '\'t'), ('\'92s', '\'s'), ('\'92m', '\'m'), ('\'92ll', '\'ll'),
+                     ('\'91', ''), ('\'92', ''), ('\'93', ''), ('\'94', '')]
+
+# Runs of spaces, joined into one
+clean_text_spaces = re.compile(r'  +')
+
+
+# Method to clean the data. The rules are applied in the same order as before, since a rule can make 
+# a match for a later one (removing '{' from 'a{0' makes an 'a0'), but each one is a single pass with 
+# str.replace or a precompiled pattern, and only runs of two or more spaces are replaced.
 def clean_text(text):    
+    text = clean_text_removed.sub('', text.replace('\n', ' '))
+    text = text.replace('a0', '')
+    # The quote rules can only match on the rare text that has a '9 in it
+    if '\'9' in text:
+        for quote, replacement in clean_text_quotes:
+            text = text.replace(quote, replacement)
+    text = text.replace('.', '. ').replace('!', '! ').replace('?', '? ')
+    return clean_text_spaces.sub(' ', text)
+
+
+# The chain of re.sub calls clean_text replaces, kept to check and time it against
+def clean_text_chain(text):    
     text = re.sub(r'\n', ' ', text) 
     text = re.sub(r'[{}@_*>()\\#%+=\[\]]','', text)
     text = re.sub('a0','', text)
@@ -104,103 +163,261 @@ def clean_text(text):
     return text
 
 
+# In[ ]:
+
+
+# Check that clean_text gives the same text as the chain of re.sub calls on the books, and time both. It reads
+# each whole book and runs the slow chain over it, so it is only run on purpose, after changing clean_text.
+check_clean_text = False
+if check_clean_text:
+    for book_path in book_paths:
+        book = "".join(iter_book_lines(book_path))
+    
+        start_time = time.time()
+        clean_chain = clean_text_chain(book)
+        chain_time = time.time() - start_time
+    
+        start_time = time.time()
+        clean = clean_text(book)
+        clean_time = time.time() - start_time
+    
+        assert clean == clean_chain
+        print("{}: {:>6.3f}s with re.sub, {:>6.3f}s with clean_text, {:>4.1f}x faster.".format(
+            book_path, chain_time, clean_time, chain_time / clean_time))
+
+
 # In[8]:
 
 
-# Clean the text of the books
-clean_books = []
-for book in books:
-    clean_books.append(clean_text(book))
+# Clean the text of a book one line at a time. None of the patterns of clean_text span a new line,
+# so this gives the same text as cleaning the whole book, apart from the spaces between lines.
+def iter_clean_text(book_path):
+    for line in iter_book_lines(book_path):
+        yield clean_text(line)
 
 
 # In[9]:
 
 
 # Check to ensure the text has been cleaned properly
-clean_books[0][:500]
+"".join(itertools.islice(iter_clean_text(book_paths[0]), 50))[:500]
 
 
 # In[10]:
 
 
-# Create a dictionary to convert the vocabulary (characters) to integers
-vocab_to_int = {}
-count = 0
-for book in clean_books:
-    for character in book:
-        if character not in vocab_to_int:
-            vocab_to_int[character] = count
-            count += 1
+# Hash of the vocabulary in id order, to check that a model and a vocabulary belong together
+def vocab_hash(vocab_to_int):
+    vocab = sorted(vocab_to_int, key=vocab_to_int.get)
+    return hashlib.sha256(json.dumps(vocab, ensure_ascii=False).encode('utf_8')).hexdigest()
 
-# Add special tokens to vocab_to_int
-codes = ['<PAD>','<EOS>','<GO>']
-for code in codes:
-    vocab_to_int[code] = count
-    count += 1
 
+# Save the vocabulary as its characters in id order together with its hash
+def save_vocab(vocab_to_int, vocab_path):
+    vocab = sorted(vocab_to_int, key=vocab_to_int.get)
+    with open(vocab_path, 'w', encoding='utf_8') as f:
+        json.dump({'version': 1, 'hash': vocab_hash(vocab_to_int), 'vocab': vocab}, f, ensure_ascii=False)
 
-# In[11]:
 
+# Load a vocabulary written by save_vocab, checking it against its hash
+def load_vocab(vocab_path):
+    with open(vocab_path, encoding='utf_8') as f:
+        artifact = json.load(f)
+    vocab_to_int = {character: value for value, character in enumerate(artifact['vocab'])}
+    if vocab_hash(vocab_to_int) != artifact['hash']:
+        raise ValueError("The vocabulary in {} does not match its hash.".format(vocab_path))
+    return vocab_to_int
 
-# Check the size of vocabulary and all of the values
-vocab_size = len(vocab_to_int)
-print("The vocabulary contains {} characters.".format(vocab_size))
+
+# In[ ]:
+
+
+# The vocabulary is kept next to the checkpoints, as the ids must stay the same as the ones the model was trained with.
+# Without one, it is built from the characters of the sentences as the books are read into the shards below.
+vocab_path = './vocab.json'
+
+if os.path.exists(vocab_path):
+    vocab_to_int = load_vocab(vocab_path)
+else:
+    vocab_to_int = {}
+loaded_vocab_size = len(vocab_to_int)
 
 
 # In[12]:
 
 
-# Create another dictionary to convert integers to their respective characters
+# Create another dictionary to convert integers to their respective characters. With a saved vocabulary it is
+# complete here, so correcting sentences does not need the books to be read.
 int_to_vocab = {}
 for character, value in vocab_to_int.items():
     int_to_vocab[value] = character
 
 
+# In[ ]:
+
+
+# The words of the cleaned text, split off from the spaces and the punctuation
+lexicon_word = re.compile(r'\w+')
+
+# A word has to be in the books this many times to be known, so that their own typos are not
+lexicon_min_count = 5
+lexicon_path = './lexicon.json'
+
+# The lexicon of known words lets the corrector skip the decoder on text that is already correct. 
+# Without one, its words are counted as the books are read into the shards below.
+if os.path.exists(lexicon_path):
+    with open(lexicon_path, encoding='utf_8') as f:
+        lexicon = set(json.load(f)['words'])
+else:
+    lexicon = None
+
+
 # In[13]:
 
 
-# Split the text from the books into sentences 
-sentences = []
-for book in clean_books:
-    for sentence in book.split('. '):
-        sentences.append(sentence + '.')
-print("Total number of sentences are {} .".format(len(sentences)))
+# Split the text of a book into sentences as it is cleaned. Only the unfinished sentence is carried over 
+# from one line to the next, where the spaces between the lines are joined as in clean_text. A '. ' at the
+# very end is not split yet, as the spaces of the next line still have to be joined to it.
+def iter_book_sentences(book_path):
+    rest = ''
+    for text in iter_clean_text(book_path):
+        text = re.sub(' +', ' ', rest + text)
+        end = text.rfind('. ', 0, len(text) - 1)
+        if end == -1:
+            rest = text
+            continue
+        for sentence in text[:end].split('. '):
+            yield sentence + '.'
+        rest = text[end + 2:]
+    for sentence in rest.split('. '):
+        yield sentence + '.'
 
 
 # In[14]:
 
 
 # check for sentence splitting correctly 
-sentences[:5]
+list(itertools.islice(iter_book_sentences(book_paths[0]), 5))
 
 
 # In[15]:
 
 
-# Convert sentences to integers
-int_sentences = []
-
-for sentence in sentences:
-    int_sentence = []
-    for character in sentence:
-        int_sentence.append(vocab_to_int[character])
-    int_sentences.append(int_sentence)
-
+# Convert the sentences of the books to integers one at a time, keeping the ones with a length we train on.
+# This is the only full read of the books, so that an epub is converted once a run: the length of every sentence 
+# is counted in length_counts, the words of each book in book_words and, if given, the words of the lexicon in
+# word_counts. A character met for the first time is added to vocab_to_int.
+def iter_int_sentences(book_paths, min_length, max_length, length_counts, book_words, word_counts=None):
+    for book_path in book_paths:
+        for sentence in iter_book_sentences(book_path):
+            length_counts[len(sentence)] += 1
+            book_words[book_path] += len(sentence.split())
+            if word_counts is not None:
+                word_counts.update(lexicon_word.findall(sentence))
+            if not vocab_to_int.keys() >= set(sentence):
+                for character in sentence:
+                    if character not in vocab_to_int:
+                        vocab_to_int[character] = len(vocab_to_int)
+            if len(sentence) <= max_length and len(sentence) >= min_length:
+                yield [vocab_to_int[character] for character in sentence]
+
+
+# Write the integer sentences to numbered shards, each one a flat array of the characters and 
+# the offsets of the sentences in it, so no more than shard_size sentences are held in memory
+class ShardWriter():
+    def __init__(self, shard_path, shard_size):
+        self.shard_path = shard_path
+        self.shard_size = shard_size
+        self.shard_i = 0
+        self.sentences = []
+        os.makedirs(shard_path, exist_ok=True)
+
+    def add(self, int_sentence):
+        self.sentences.append(int_sentence)
+        if len(self.sentences) == self.shard_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.sentences) == 0:
+            return
+        offsets = np.zeros(len(self.sentences) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(sentence) for sentence in self.sentences])
+        tokens = np.fromiter(itertools.chain.from_iterable(self.sentences), dtype=np.uint16, count=offsets[-1])
+        
+        shard_name = join(self.shard_path, 'shard-{:05d}'.format(self.shard_i))
+        np.save(shard_name + '.tokens.npy', tokens)
+        np.save(shard_name + '.offsets.npy', offsets)
+        self.shard_i += 1
+        self.sentences = []
+
+    def close(self):
+        self.flush()
+
+
+# Join the shards into one flat array of characters and one array of sentence offsets. 
+# The characters are copied a shard at a time into an array on disk, using one byte each when the vocabulary fits.
+# The store is written under temporary names, since other processes may be training on the one in place: 
+# an unchanged store is left as it is, and a changed one is moved into place as new files, which does not 
+# touch the pages those processes have mapped.
+def build_sentence_store(shard_path, store_path):
+    tokens_files = sorted(glob(join(shard_path, 'shard-*.tokens.npy')))
+    shard_offsets = [np.load(tokens_file.replace('.tokens.npy', '.offsets.npy')) for tokens_file in tokens_files]
+    
+    dtype = np.uint8 if len(vocab_to_int) <= 256 else np.uint16
+    tokens = np.lib.format.open_memmap(store_path + '.tmp.tokens.npy', mode='w+', dtype=dtype, 
+                                       shape=(int(sum([offsets[-1] for offsets in shard_offsets])),))
+    offsets = np.zeros(sum([len(offsets) - 1 for offsets in shard_offsets]) + 1, dtype=np.int64)
+    
+    position = 0
+    sentence_i = 0
+    for tokens_file, shard_offset in zip(tokens_files, shard_offsets):
+        tokens[position:position + shard_offset[-1]] = np.load(tokens_file, mmap_mode='r')
+        offsets[sentence_i + 1:sentence_i + len(shard_offset)] = shard_offset[1:] + position
+        position += shard_offset[-1]
+        sentence_i += len(shard_offset) - 1
+    
+    tokens.flush()
+    del tokens
+    np.save(store_path + '.tmp.offsets.npy', offsets)
+    
+    for suffix in ['.tokens.npy', '.offsets.npy']:
+        if os.path.exists(store_path + suffix) and filecmp.cmp(store_path + '.tmp' + suffix, store_path + suffix, 
+                                                               shallow=False):
+            os.remove(store_path + '.tmp' + suffix)
+        else:
+            os.replace(store_path + '.tmp' + suffix, store_path + suffix)
 
-# In[16]:
 
+# The encoded sentences, memory-mapped from disk so that processes using the same store share its pages.
+# A sentence is a slice of the flat array and only the path is pickled when the store is sent to a worker.
+# The lengths of all the sentences are only computed when they are first asked for.
+class SentenceStore():
+    def __init__(self, store_path):
+        self.store_path = store_path
+        self.tokens = np.load(store_path + '.tokens.npy', mmap_mode='r')
+        self.offsets = np.load(store_path + '.offsets.npy', mmap_mode='r')
+        # Opened while build_sentence_store was moving a new store into place
+        if self.offsets[-1] != len(self.tokens):
+            raise ValueError("The sentence store {} is being rebuilt, open it again.".format(store_path))
+        self._lengths = None
 
-# Find the length of each sentence
-lengths = []
-for sentence in int_sentences:
-    lengths.append(len(sentence))
-lengths = pd.DataFrame(lengths, columns=["counts"])
+    @property
+    def lengths(self):
+        if self._lengths is None:
+            self._lengths = np.diff(self.offsets)
+        return self._lengths
 
+    def __len__(self):
+        return len(self.offsets) - 1
 
-# In[17]:
+    def __getitem__(self, i):
+        return self.tokens[self.offsets[i]:self.offsets[i + 1]]
 
+    def __getstate__(self):
+        return self.store_path
 
-lengths.describe()
+    def __setstate__(self, store_path):
+        self.__init__(store_path)
 
 
 # In[18]:
@@ -210,11 +427,81 @@ lengths.describe()
 max_length = 92
 min_length = 10
 
-good_sentences = []
+# Stream the books into shards, replacing the ones of an earlier run
+shard_path = './books/shards/'
+shard_size = 100000
+
+for shard_file in glob(join(shard_path, 'shard-*.npy')):
+    os.remove(shard_file)
+
+length_counts = Counter()
+book_words = Counter()
+word_counts = Counter() if lexicon is None else None
+writer = ShardWriter(shard_path, shard_size)
+for int_sentence in iter_int_sentences(book_paths, min_length, max_length, length_counts, book_words, word_counts):
+    writer.add(int_sentence)
+writer.close()
+
+# Getting number of words in each book 
+for book_path, book in zip(book_paths, book_files):
+    print("The number of {} words in book of named {}.".format(book_words[book_path], book))
+
+print("Total number of sentences are {} .".format(sum(length_counts.values())))
+
+
+# In[ ]:
+
+
+# Save the vocabulary and the lexicon built from the books
+if not os.path.exists(vocab_path):
+    # Add special tokens to vocab_to_int
+    codes = ['<PAD>','<EOS>','<GO>']
+    for code in codes:
+        vocab_to_int[code] = len(vocab_to_int)
+elif len(vocab_to_int) > loaded_vocab_size:
+    # New books brought characters that were not in the vocabulary. They are added after the existing ids, 
+    # and the models trained with the old vocabulary are refused by its new hash when they are loaded.
+    print("Added {} new characters to {}, the models trained before will have to be trained again.".format(
+        len(vocab_to_int) - loaded_vocab_size, vocab_path))
+
+if len(vocab_to_int) > loaded_vocab_size:
+    save_vocab(vocab_to_int, vocab_path)
+    for character, value in vocab_to_int.items():
+        int_to_vocab[value] = character
+
+if lexicon is None:
+    lexicon = {word for word, count in word_counts.items() if count >= lexicon_min_count}
+    
+    with open(lexicon_path, 'w', encoding='utf_8') as f:
+        json.dump({'version': 1, 'min_count': lexicon_min_count, 'words': sorted(lexicon)}, f, ensure_ascii=False)
+
+print("The lexicon contains {} words.".format(len(lexicon)))
+
+
+# In[11]:
+
+
+# Check the size of vocabulary and all of the values
+vocab_size = len(vocab_to_int)
+print("The vocabulary contains {} characters.".format(vocab_size))
+
+
+# In[16]:
+
+
+# Find the statistics of the sentence lengths, with each length repeated once for every sentence of that length
+sentence_lengths, sentence_counts = zip(*sorted(length_counts.items()))
+lengths = pd.DataFrame({"length": np.repeat(np.array(sentence_lengths, dtype=np.int32), sentence_counts)})
+lengths.describe()
+
+
+# In[ ]:
+
 
-for sentence in int_sentences:
-    if len(sentence) <= max_length and len(sentence) >= min_length:
-        good_sentences.append(sentence)
+# Keep the sentences we train on in one memory-mapped store instead of lists of integers
+store_path = './books/sentences'
+build_sentence_store(shard_path, store_path)
+good_sentences = SentenceStore(store_path)
 
 print("Total number of {} sentences to train and test our model.".format(len(good_sentences)))
 
@@ -222,8 +509,8 @@ print("Total number of {} sentences to train and test our model.".format(len(goo
 # In[19]:
 
 
-# Split the data into training and testing sentences
-training, testing = train_test_split(good_sentences, test_size = 0.15, random_state = 2)
+# Split the ids of the sentences into training and testing sentences
+training, testing = train_test_split(np.arange(len(good_sentences)), test_size = 0.15, random_state = 2)
 
 print("Number of training sentences:", len(training))
 print("Number of testing sentences:", len(testing))
@@ -232,30 +519,33 @@ print("Number of testing sentences:", len(testing))
 # In[20]:
 
 
+# Group the ids of the sentences by their length with one stable sort, so the ids keep their order within a bucket
+def bucket_by_length(ids, lengths):
+    order = np.argsort(lengths, kind='mergesort')
+    bucket_lengths, starts = np.unique(lengths[order], return_index=True)
+    return dict(zip(bucket_lengths.tolist(), np.split(ids[order], starts[1:])))
+
+
 # Sort the sentences by length to reduce padding, which will allow the model to train faster
-training_sorted = []
-testing_sorted = []
+training_buckets = bucket_by_length(training, good_sentences.lengths[training])
+testing_buckets = bucket_by_length(testing, good_sentences.lengths[testing])
 
-for i in range(min_length, max_length+1):
-    for sentence in training:
-        if len(sentence) == i:
-            training_sorted.append(sentence)
-    for sentence in testing:
-        if len(sentence) == i:
-            testing_sorted.append(sentence)
+training_sorted = np.concatenate([training_buckets[length] for length in sorted(training_buckets)])
+testing_sorted = np.concatenate([testing_buckets[length] for length in sorted(testing_buckets)])
 
 
 # In[21]:
 
 
 # Check to ensure the sentences have been selected and sorted correctly
-for i in range(5):
-    print(training_sorted[i], len(training_sorted[i]))
+for i in training_sorted[:5]:
+    print(good_sentences[i], len(good_sentences[i]))
 
 
 # In[22]:
 
-accented_chars_vietnamese = list(map(lambda letters: map(lambda letter: vocab_to_int[letter], letters), [
+# Groups of the same vowel with different diacritics, as lists of ids so they can be used more than once
+accented_chars_vietnamese = [[vocab_to_int[letter] for letter in letters if letter in vocab_to_int] for letters in [
     ['a', 'á', 'à', 'ả', 'ã', 'ạ', 'â', 'ấ', 'ầ', 'ẩ', 'ẫ', 'ậ', 'ă', 'ắ', 'ằ', 'ẳ', 'ẵ', 'ặ'],
     ['o', 'ó', 'ò', 'ỏ', 'õ', 'ọ', 'ô', 'ố', 'ồ', 'ổ', 'ỗ', 'ộ', 'ơ', 'ớ', 'ờ', 'ở', 'ỡ', 'ợ'],
     ['e', 'é', 'è', 'ẻ', 'ẽ', 'ẹ', 'ê', 'ế', 'ề', 'ể', 'ễ', 'ệ'],
@@ -263,7 +553,7 @@ accented_chars_vietnamese = list(map(lambda letters: map(lambda letter: vocab_to
     ['i', 'í', 'ì', 'ỉ', 'ĩ', 'ị'],
     ['y', 'ý', 'ỳ', 'ỷ', 'ỹ', 'ỵ'],
     ['d', 'đ'],
-]))
+]]
 
 accented_chars_vietnamese_all = []
 
@@ -304,27 +594,23 @@ def noise_maker0(sentence, threshold):
         i += 1
     return noisy_sentence
 
-def noise_maker(sentence, threshold):
-    noisy_sentence = []
-    noisy_set = []
-
-    for index, letter in enumerate(sentence):
-        noisy = []
-        for set in accented_chars_vietnamese:
-            for ch in set:
-                if ch == letter:
-                    noisy = set
+# Look up tables from a character id to its accent group (-1 if it has no accents) and from a group to its members
+accent_group_of = np.full(len(vocab_to_int), -1, dtype=np.int32)
+accent_group_size = np.array([len(group) for group in accented_chars_vietnamese], dtype=np.int32)
+accent_groups = np.zeros((len(accented_chars_vietnamese), accent_group_size.max()), dtype=np.int32)
+for group_i, group in enumerate(accented_chars_vietnamese):
+    accent_groups[group_i, :len(group)] = group
+    accent_group_of[group] = group_i
+
+# Replace accented characters of a whole padded batch with a random character of their group
+def noise_maker_batch(batch, threshold, rng=np.random):
+    groups = accent_group_of[batch]
+    noisy = (groups >= 0) & (rng.random_sample(batch.shape) < threshold)
+    choices = (rng.random_sample(batch.shape) * accent_group_size[groups]).astype(np.int32)
+    return np.where(noisy, accent_groups[groups, choices], batch)
 
-        noisy_set.append(noisy)
-
-    for index, letter in enumerate(sentence):
-        char = sentence[index]
-        if len(noisy_set[index]) > 0 and random.random() < threshold:
-            char_set = noisy_set[index]
-            char = random.choice(char_set)
-        noisy_sentence.append(char)
-
-    return noisy_sentence
+def noise_maker(sentence, threshold):
+    return noise_maker_batch(np.array(sentence, dtype=np.int32), threshold).tolist()
 
 
 # In[23]:
@@ -332,7 +618,7 @@ def noise_maker(sentence, threshold):
 
 # Check to ensure noise_maker is making mistakes correctly.
 threshold = 0.9
-for sentence in training_sorted[:5]:
+for sentence in [good_sentences[i].tolist() for i in training_sorted[:5]]:
     print(sentence)
     print(noise_maker(sentence, threshold))
     print()
@@ -374,47 +660,56 @@ def process_encoding_input(targets, vocab_to_int, batch_size):
 # In[26]:
 
 
-# Create the encoding layer
-def encoding_layer(rnn_size, sequence_length, num_layers, rnn_inputs, keep_prob, direction):   
+# Create an LSTM cell with dropout on its inputs. With fused_lstm the cell is an LSTMBlockCell, which runs
+# the whole step in one kernel and is faster on the CPU. Its weights are named differently from the ones of 
+# LSTMCell, so a checkpoint can only be restored with the same kind of cell it was trained with.
+def lstm_cell(rnn_size, keep_prob, fused_lstm):
+    if fused_lstm:
+        lstm = tf.contrib.rnn.LSTMBlockCell(rnn_size)
+    else:
+        lstm = tf.contrib.rnn.LSTMCell(rnn_size)
+    return tf.contrib.rnn.DropoutWrapper(lstm, 
+                                         input_keep_prob = keep_prob)
+
+
+# Create the encoding layer. Each layer reads the outputs of the layer below it, 
+# and the states of all the layers are returned to start the layers of the decoder.
+def encoding_layer(rnn_size, sequence_length, num_layers, rnn_inputs, keep_prob, direction, fused_lstm=False):   
     
+    enc_state = []
     if direction == 1:
         with tf.name_scope("RNN_Encoder_Cell_1D"):
             for layer in range(num_layers):
                 with tf.variable_scope('encoder_{}'.format(layer)):
-                    lstm = tf.contrib.rnn.LSTMCell(rnn_size)
+                    drop = lstm_cell(rnn_size, keep_prob, fused_lstm)
 
-                    drop = tf.contrib.rnn.DropoutWrapper(lstm, 
-                                                         input_keep_prob = keep_prob)
+                    rnn_inputs, state = tf.nn.dynamic_rnn(drop, 
+                                                          rnn_inputs,
+                                                          sequence_length,
+                                                          dtype=tf.float32)
+                    enc_state.append(state)
 
-                    enc_output, enc_state = tf.nn.dynamic_rnn(drop, 
-                                                              rnn_inputs,
-                                                              sequence_length,
-                                                              dtype=tf.float32)
-
-            return enc_output, enc_state
+            return rnn_inputs, tuple(enc_state)
         
         
     if direction == 2:
         with tf.name_scope("RNN_Encoder_Cell_2D"):
             for layer in range(num_layers):
                 with tf.variable_scope('encoder_{}'.format(layer)):
-                    cell_fw = tf.contrib.rnn.LSTMCell(rnn_size)
-                    cell_fw = tf.contrib.rnn.DropoutWrapper(cell_fw, 
-                                                            input_keep_prob = keep_prob)
-
-                    cell_bw = tf.contrib.rnn.LSTMCell(rnn_size)
-                    cell_bw = tf.contrib.rnn.DropoutWrapper(cell_bw, 
-                                                            input_keep_prob = keep_prob)
-
-                    enc_output, enc_state = tf.nn.bidirectional_dynamic_rnn(cell_fw, 
-                                                                            cell_bw, 
-                                                                            rnn_inputs,
-                                                                            sequence_length,
-                                                                            dtype=tf.float32)
-            # Join outputs since we are using a bidirectional RNN
-            enc_output = tf.concat(enc_output,2)
-            # Use only the forward state because the model can't use both states at once
-            return enc_output, enc_state[0]
+                    cell_fw = lstm_cell(rnn_size, keep_prob, fused_lstm)
+                    cell_bw = lstm_cell(rnn_size, keep_prob, fused_lstm)
+
+                    enc_output, state = tf.nn.bidirectional_dynamic_rnn(cell_fw, 
+                                                                        cell_bw, 
+                                                                        rnn_inputs,
+                                                                        sequence_length,
+                                                                        dtype=tf.float32)
+                    # Join outputs since we are using a bidirectional RNN
+                    rnn_inputs = tf.concat(enc_output,2)
+                    # Use only the forward state because the model can't use both states at once
+                    enc_state.append(state[0])
+            
+            return rnn_inputs, tuple(enc_state)
 
 
 # In[27]:
@@ -444,16 +739,31 @@ def training_decoding_layer(dec_embed_input, targets_length, dec_cell, initial_s
 # In[28]:
 
 
+# Greedy decoding where a sentence is also finished once it has as many characters as its targets_length,
+# so that the short sentences of a batch stop there and the decoding ends when every sentence has stopped
+class LengthLimitedEmbeddingHelper(tf.contrib.seq2seq.GreedyEmbeddingHelper):
+    def __init__(self, embedding, start_tokens, end_token, sequence_length):
+        super(LengthLimitedEmbeddingHelper, self).__init__(embedding, start_tokens, end_token)
+        self._sequence_length = sequence_length
+
+    def next_inputs(self, time, outputs, state, sample_ids, name=None):
+        finished, next_inputs, state = super(LengthLimitedEmbeddingHelper, self).next_inputs(
+            time, outputs, state, sample_ids, name)
+        finished = tf.logical_or(finished, time + 1 >= self._sequence_length)
+        return finished, next_inputs, state
+
+
 # Create the inference logits
 def inference_decoding_layer(embeddings, start_token, end_token, dec_cell, initial_state, output_layer,
-                             max_target_length, batch_size):    
+                             max_target_length, batch_size, targets_length):    
     
     with tf.name_scope("Inference_Decoder"):
         start_tokens = tf.tile(tf.constant([start_token], dtype=tf.int32), [batch_size], name='start_tokens')
 
-        inference_helper = tf.contrib.seq2seq.GreedyEmbeddingHelper(embeddings,
-                                                                    start_tokens,
-                                                                    end_token)
+        inference_helper = LengthLimitedEmbeddingHelper(embeddings,
+                                                        start_tokens,
+                                                        end_token,
+                                                        targets_length)
 
         inference_decoder = tf.contrib.seq2seq.BasicDecoder(dec_cell,
                                                             inference_helper,
@@ -468,23 +778,135 @@ def inference_decoding_layer(embeddings, start_token, end_token, dec_cell, initi
         return inference_logits
 
 
+# In[ ]:
+
+
+# Repeat every sentence of a batch beam_width times, next to each other
+def tile_beams(t, beam_width):
+    
+    shape = t.get_shape().as_list()
+    tiled = tf.tile(tf.expand_dims(t, 1), [1, beam_width] + [1] * (len(shape) - 1))
+    tiled = tf.reshape(tiled, tf.concat([[-1], tf.shape(t)[1:]], 0))
+    tiled.set_shape([None] + shape[1:])
+    return tiled
+
+
+# Follow the parent of every beam back from the last step to get the ids of the whole beams
+def gather_beams(step_ids, step_parents, batch_size, beam_width):
+    
+    batch_index = tf.tile(tf.expand_dims(tf.range(batch_size), 1), [1, beam_width])
+
+    def step(beams_ids, ids_parents):
+        beams, _ = beams_ids
+        ids, parents = ids_parents
+        indices = tf.stack([batch_index, beams], 2)
+        return tf.gather_nd(parents, indices), tf.gather_nd(ids, indices)
+
+    last_beams = tf.tile(tf.expand_dims(tf.range(beam_width), 0), [batch_size, 1])
+    _, beam_ids = tf.scan(step, 
+                          (tf.reverse(step_ids, [0]), tf.reverse(step_parents, [0])), 
+                          initializer=(last_beams, tf.zeros_like(last_beams)))
+    
+    # [time, batch, beam] to [batch, beam, time]
+    return tf.transpose(tf.reverse(beam_ids, [0]), [1, 2, 0])
+
+
+# Create the beam search inference logits, with the same decoding cell and output layer as the greedy decoder.
+# The scores are the log probabilities divided by the GNMT length penalty ((5 + length) / 6) ** length_penalty.
+# Like the greedy decoder, the beams of a sentence are finished once they have targets_length characters.
+def beam_search_decoding_layer(embeddings, start_token, end_token, dec_cell, initial_state, output_layer,
+                               max_target_length, batch_size, beam_width, length_penalty, vocab_size, 
+                               targets_length):
+    
+    with tf.name_scope("Beam_Search_Decoder"):
+        # All of the beams of a sentence start the same, so only the first one is expanded at the first step
+        log_probs = tf.one_hot(tf.zeros([batch_size], dtype=tf.int32), beam_width, on_value=0.0, off_value=-1e9)
+        finished = tf.zeros([batch_size, beam_width], dtype=tf.bool)
+        lengths = tf.zeros([batch_size, beam_width], dtype=tf.int32)
+        inputs = tf.nn.embedding_lookup(embeddings, tf.fill([batch_size * beam_width], start_token))
+        
+        # A finished beam can only be followed by <EOS>, which does not change its score
+        eos_only = tf.one_hot(end_token, vocab_size, on_value=0.0, off_value=-1e9)
+        beam_offsets = tf.expand_dims(tf.range(batch_size) * beam_width, 1)
+        
+        def penalty(lengths):
+            return tf.pow((5.0 + tf.to_float(lengths)) / 6.0, length_penalty)
+        
+        def condition(time, cell_state, inputs, log_probs, finished, lengths, step_ids, step_parents):
+            return tf.logical_and(time < max_target_length, tf.logical_not(tf.reduce_all(finished)))
+        
+        def body(time, cell_state, inputs, log_probs, finished, lengths, step_ids, step_parents):
+            cell_output, cell_state = dec_cell(inputs, cell_state)
+            step_log_probs = tf.reshape(tf.nn.log_softmax(output_layer(cell_output)), 
+                                        [batch_size, beam_width, vocab_size])
+            
+            not_finished = tf.to_float(tf.logical_not(finished))
+            step_log_probs = (step_log_probs * tf.expand_dims(not_finished, 2) + 
+                              eos_only * tf.expand_dims(1.0 - not_finished, 2))
+            total_log_probs = tf.expand_dims(log_probs, 2) + step_log_probs
+            next_lengths = lengths + tf.to_int32(not_finished)
+            
+            # Keep the beam_width best of all the continuations of all the beams of a sentence
+            scores = total_log_probs / tf.expand_dims(penalty(next_lengths), 2)
+            _, top_indices = tf.nn.top_k(tf.reshape(scores, [batch_size, -1]), beam_width)
+            parents = top_indices // vocab_size
+            ids = top_indices % vocab_size
+            
+            beam_indices = tf.reshape(beam_offsets + parents, [-1])
+            log_probs = tf.reshape(tf.gather(tf.reshape(total_log_probs, [-1]), 
+                                             tf.reshape(beam_offsets * vocab_size + top_indices, [-1])), 
+                                   [batch_size, beam_width])
+            finished = tf.logical_or(tf.reshape(tf.gather(tf.reshape(finished, [-1]), beam_indices), 
+                                                [batch_size, beam_width]), 
+                                     tf.equal(ids, end_token))
+            finished = tf.logical_or(finished, tf.expand_dims(time + 1 >= targets_length, 1))
+            lengths = tf.reshape(tf.gather(tf.reshape(next_lengths, [-1]), beam_indices), [batch_size, beam_width])
+            cell_state = nest.map_structure(lambda state: tf.gather(state, beam_indices), cell_state)
+            inputs = tf.nn.embedding_lookup(embeddings, tf.reshape(ids, [-1]))
+            
+            return (time + 1, cell_state, inputs, log_probs, finished, lengths, 
+                    step_ids.write(time, ids), step_parents.write(time, parents))
+        
+        # The same variable scope as dynamic_decode, so the weights of the greedy decoder are used
+        with tf.variable_scope("decoder"):
+            loop_vars = (tf.constant(0), initial_state, inputs, log_probs, finished, lengths,
+                         tf.TensorArray(tf.int32, size=0, dynamic_size=True),
+                         tf.TensorArray(tf.int32, size=0, dynamic_size=True))
+            _, _, _, log_probs, _, lengths, step_ids, step_parents = tf.while_loop(condition, body, loop_vars)
+        
+        beam_ids = gather_beams(step_ids.stack(), step_parents.stack(), batch_size, beam_width)
+        beam_scores = log_probs / penalty(lengths)
+
+        return beam_ids, beam_scores
+
+
 # In[29]:
 
 
 # Create the decoding cell and attention for the training and inference decoding layers
 def decoding_layer(dec_embed_input, embeddings, enc_output, enc_state, vocab_size, inputs_length, targets_length, 
-                   max_target_length, rnn_size, vocab_to_int, keep_prob, batch_size, num_layers, direction):  
+                   max_target_length, rnn_size, vocab_to_int, keep_prob, batch_size, num_layers, direction,
+                   inference_only=False, beam_width=None, length_penalty=None, fused_lstm=False):  
     
+    # The layers of the decoder are stacked like the ones of the encoder, and start from their states
     with tf.name_scope("RNN_Decoder_Cell"):
+        cells = []
         for layer in range(num_layers):
             with tf.variable_scope('decoder_{}'.format(layer)):
-                lstm = tf.contrib.rnn.LSTMCell(rnn_size)
-                dec_cell = tf.contrib.rnn.DropoutWrapper(lstm, 
-                                                         input_keep_prob = keep_prob)
+                cells.append(lstm_cell(rnn_size, keep_prob, fused_lstm))
+        dec_cell = tf.contrib.rnn.MultiRNNCell(cells)
     
     output_layer = Dense(vocab_size,
                          kernel_initializer = tf.truncated_normal_initializer(mean = 0.0, stddev=0.1))
     
+    # Beam search decodes every sentence beam_width times, so the encoder results are repeated to match
+    dec_batch_size = batch_size
+    if beam_width is not None:
+        enc_output = tile_beams(enc_output, beam_width)
+        enc_state = nest.map_structure(lambda state: tile_beams(state, beam_width), enc_state)
+        inputs_length = tile_beams(inputs_length, beam_width)
+        dec_batch_size = batch_size * beam_width
+    
     attn_mech = tf.contrib.seq2seq.BahdanauAttention(rnn_size,
                                                   enc_output,
                                                   inputs_length,
@@ -498,26 +920,44 @@ def decoding_layer(dec_embed_input, embeddings, enc_output, enc_state, vocab_siz
     
     initial_state = tf.contrib.seq2seq.DynamicAttentionWrapperState(enc_state,
                                                                     _zero_state_tensors(rnn_size, 
-                                                                                        batch_size, 
+                                                                                        dec_batch_size, 
                                                                                         tf.float32))
 
-    with tf.variable_scope("decode"):
-        training_logits = training_decoding_layer(dec_embed_input, 
-                                                  targets_length, 
-                                                  dec_cell, 
-                                                  initial_state,
-                                                  output_layer,
-                                                  vocab_size, 
-                                                  max_target_length)
-    with tf.variable_scope("decode", reuse=True):
-        inference_logits = inference_decoding_layer(embeddings,  
-                                                    vocab_to_int['<GO>'], 
-                                                    vocab_to_int['<EOS>'],
-                                                    dec_cell, 
-                                                    initial_state, 
-                                                    output_layer,
-                                                    max_target_length,
-                                                    batch_size)
+    # The training decoder is not needed to correct sentences, so it can be left out of the graph
+    training_logits = None
+    if not inference_only:
+        with tf.variable_scope("decode"):
+            training_logits = training_decoding_layer(dec_embed_input, 
+                                                      targets_length, 
+                                                      dec_cell, 
+                                                      initial_state,
+                                                      output_layer,
+                                                      vocab_size, 
+                                                      max_target_length)
+    with tf.variable_scope("decode", reuse=not inference_only):
+        if beam_width is None:
+            inference_logits = inference_decoding_layer(embeddings,  
+                                                        vocab_to_int['<GO>'], 
+                                                        vocab_to_int['<EOS>'],
+                                                        dec_cell, 
+                                                        initial_state, 
+                                                        output_layer,
+                                                        max_target_length,
+                                                        batch_size,
+                                                        targets_length)
+        else:
+            inference_logits = beam_search_decoding_layer(embeddings,  
+                                                          vocab_to_int['<GO>'], 
+                                                          vocab_to_int['<EOS>'],
+                                                          dec_cell, 
+                                                          initial_state, 
+                                                          output_layer,
+                                                          max_target_length,
+                                                          batch_size,
+                                                          beam_width,
+                                                          length_penalty,
+                                                          vocab_size,
+                                                          targets_length)
 
     return training_logits, inference_logits
 
@@ -527,16 +967,19 @@ def decoding_layer(dec_embed_input, embeddings, enc_output, enc_state, vocab_siz
 
 # Use the previous functions to create the training and inference logits
 def seq2seq_model(inputs, targets, keep_prob, inputs_length, targets_length, max_target_length, 
-                  vocab_size, rnn_size, num_layers, vocab_to_int, batch_size, embedding_size, direction):    
+                  vocab_size, rnn_size, num_layers, vocab_to_int, batch_size, embedding_size, direction,
+                  inference_only=False, beam_width=None, length_penalty=None, fused_lstm=False):    
     
     enc_embeddings = tf.Variable(tf.random_uniform([vocab_size, embedding_size], -1, 1))
     enc_embed_input = tf.nn.embedding_lookup(enc_embeddings, inputs)
     enc_output, enc_state = encoding_layer(rnn_size, inputs_length, num_layers, 
-                                           enc_embed_input, keep_prob, direction)
+                                           enc_embed_input, keep_prob, direction, fused_lstm)
     
     dec_embeddings = tf.Variable(tf.random_uniform([vocab_size, embedding_size], -1, 1))
-    dec_input = process_encoding_input(targets, vocab_to_int, batch_size)
-    dec_embed_input = tf.nn.embedding_lookup(dec_embeddings, dec_input)
+    dec_embed_input = None
+    if not inference_only:
+        dec_input = process_encoding_input(targets, vocab_to_int, batch_size)
+        dec_embed_input = tf.nn.embedding_lookup(dec_embeddings, dec_input)
     
     training_logits, inference_logits  = decoding_layer(dec_embed_input, 
                                                         dec_embeddings,
@@ -551,7 +994,11 @@ def seq2seq_model(inputs, targets, keep_prob, inputs_length, targets_length, max
                                                         keep_prob, 
                                                         batch_size,
                                                         num_layers,
-                                                        direction)
+                                                        direction,
+                                                        inference_only,
+                                                        beam_width,
+                                                        length_penalty,
+                                                        fused_lstm)
     
     return training_logits, inference_logits
 
@@ -568,34 +1015,93 @@ def pad_sentence_batch(sentence_batch):
 # In[32]:
 
 
+# Pad a batch of sentences into arrays, add <EOS> to the targets and add the mistakes to the inputs in one go
+def make_batch(sentences_batch, threshold, rng=np.random):
+    max_sentence = max([len(sentence) for sentence in sentences_batch])
+    
+    pad_sentences_batch = np.full((len(sentences_batch), max_sentence + 1), vocab_to_int['<PAD>'], dtype=np.int32)
+    for i, sentence in enumerate(sentences_batch):
+        pad_sentences_batch[i, :len(sentence)] = sentence
+    
+    # <PAD> has no accent group, so the padding is never changed by the noise
+    pad_sentences_noisy_batch = noise_maker_batch(pad_sentences_batch[:, :-1], threshold, rng)
+    
+    sentences_lengths = [len(sentence) for sentence in sentences_batch]
+    pad_sentences_batch[np.arange(len(sentences_batch)), sentences_lengths] = vocab_to_int['<EOS>']
+    
+    # Need the lengths for the _lengths parameters
+    pad_sentences_lengths = [pad_sentences_batch.shape[1]] * len(sentences_batch)
+    pad_sentences_noisy_lengths = [pad_sentences_noisy_batch.shape[1]] * len(sentences_batch)
+    
+    return pad_sentences_noisy_batch, pad_sentences_batch, pad_sentences_noisy_lengths, pad_sentences_lengths
+
+
 # Batch sentences, noisy sentences, and the lengths of their sentences together.With each epoch, sentences will receive new mistakes"
-def get_batches(sentences, batch_size, threshold):    
-    for batch_i in range(0, len(sentences)//batch_size):
+def get_batches(sentences, ids, batch_size, threshold, rng=np.random):    
+    for batch_i in range(0, len(ids)//batch_size):
         start_i = batch_i * batch_size
-        sentences_batch = sentences[start_i:start_i + batch_size]
-        
-        sentences_batch_noisy = []
-        for sentence in sentences_batch:
-            sentences_batch_noisy.append(noise_maker(sentence, threshold))
-            
-        sentences_batch_eos = []
-        for sentence in sentences_batch:
-            sentence.append(vocab_to_int['<EOS>'])
-            sentences_batch_eos.append(sentence)
-            
-        pad_sentences_batch = np.array(pad_sentence_batch(sentences_batch_eos))
-        pad_sentences_noisy_batch = np.array(pad_sentence_batch(sentences_batch_noisy))
-        
-        # Need the lengths for the _lengths parameters
-        pad_sentences_lengths = []
-        for sentence in pad_sentences_batch:
-            pad_sentences_lengths.append(len(sentence))
-        
-        pad_sentences_noisy_lengths = []
-        for sentence in pad_sentences_noisy_batch:
-            pad_sentences_noisy_lengths.append(len(sentence))
-        
-        yield pad_sentences_noisy_batch, pad_sentences_batch, pad_sentences_noisy_lengths, pad_sentences_lengths
+        yield make_batch([sentences[i] for i in ids[start_i:start_i + batch_size]], threshold, rng)
+
+
+# In[ ]:
+
+
+# Make the batches of an epoch from the length buckets. The sentences are shuffled within their bucket and the 
+# batches across buckets. With a token_budget a batch holds as many sentences as fit in that many characters,
+# otherwise batch_size sentences.
+def bucket_batches(buckets, batch_size, token_budget, rng=np.random):
+    batches = []
+    for length, indices in sorted(buckets.items()):
+        indices = rng.permutation(indices)
+        if token_budget:
+            # The targets are one character longer because of <EOS>
+            size = max(1, token_budget // (length + 1))
+        else:
+            size = batch_size
+        for start_i in range(0, len(indices), size):
+            batches.append(indices[start_i:start_i + size])
+    rng.shuffle(batches)
+    return batches
+
+
+# Make one batch with its own random state, so it gets the same mistakes whichever worker makes it
+# The sentences the batches of a worker are made from, given once when the worker starts
+worker_sentences = None
+
+
+def init_batch_worker(sentences):
+    global worker_sentences
+    worker_sentences = sentences
+
+
+def make_seeded_batch(args):
+    batch, threshold, seed = args
+    return make_batch([worker_sentences[i] for i in batch], threshold, np.random.RandomState(seed))
+
+
+# Make the batches of sentence ids in background workers while the model trains.
+# Each batch is seeded with (seed, epoch_i, batch_i), so every epoch still gets new mistakes and runs are reproducible.
+# The batches before first_batch are skipped, to continue an epoch where it stopped.
+def prefetch_batches(sentences, batches, threshold, seed, epoch_i, num_workers, prefetch, first_batch=0):
+    # The store is only sent once to each worker, which opens it when it starts
+    if 'fork' in multiprocessing.get_all_start_methods():
+        pool = multiprocessing.get_context('fork').Pool(num_workers, init_batch_worker, (sentences,))
+    else:
+        # Without fork the workers could not see the vocabulary, so use threads instead
+        pool = ThreadPool(num_workers, init_batch_worker, (sentences,))
+    
+    pending = deque()
+    try:
+        for batch_i, batch in enumerate(batches[first_batch:], first_batch):
+            # Only the ids are sent, the worker reads the sentences from the store
+            args = (batch, threshold, [seed, epoch_i, batch_i])
+            pending.append(pool.apply_async(make_seeded_batch, (args,)))
+            if len(pending) > prefetch:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
 
 
 # In[33]:
@@ -611,21 +1117,49 @@ learning_rate = 0.0005
 direction = 2
 threshold = 0.2
 keep_probability = 0.75
+diagnostics_step = 100 # Run the inference decoder for the predictions histogram every 100 batches
+noise_seed = 2 # Seed of the mistakes added to the training batches
+batch_workers = 2 # Number of background workers making the training batches
+batch_prefetch = 8 # Number of training batches made ahead of the model
+token_budget = None # If set, size the training batches by this many characters instead of batch_size sentences
+log_train_summaries = True # Write the cost summary of every training batch to ./logs/train/
+checkpoints_to_keep = 3 # Number of the latest new record checkpoints kept
+resume_training = True # Continue a run from its latest checkpoint, if it has one
+validation_size = 2000 # Testing sentences in the validation checks, which keep their mistakes. None for all of them
+full_validation = False # Also check the whole testing set with new mistakes at the end of each epoch
+fused_lstm = False # Use LSTMBlockCell, faster on the CPU, checkpoints only restore with the same setting
 
 
 # In[34]:
 
 
 # Method to build the graph
-def build_graph(keep_prob, rnn_size, num_layers, batch_size, learning_rate, embedding_size, direction):
+def build_graph(keep_prob, rnn_size, num_layers, batch_size, learning_rate, embedding_size, direction,
+                inference_only=False, beam_search=False, fused_lstm=False):
+
+    if beam_search and not inference_only:
+        raise ValueError("Beam search can only be built in an inference only graph.")
 
     tf.reset_default_graph()
     
     # Load the model inputs    
     inputs, targets, keep_prob, inputs_length, targets_length, max_target_length = model_inputs()
 
-    # Create the training and inference logits
-    training_logits, inference_logits = seq2seq_model(tf.reverse(inputs, [-1]),
+    # Take the batch size from the inputs so that any number of sentences can be fed at once
+    batch_size = tf.shape(inputs, name='batch_size')[0]
+
+    # The beam width and the length penalty can be chosen for each run, a width of 1 is greedy decoding
+    beam_width, length_penalty = None, None
+    if beam_search:
+        beam_width = tf.placeholder_with_default(1, [], name='beam_width')
+        length_penalty = tf.placeholder_with_default(0.0, [], name='length_penalty')
+
+    # The hash of the vocabulary, so that a frozen graph still tells which vocabulary it needs
+    tf.constant(vocab_hash(vocab_to_int), name='vocab_hash')
+
+    # Create the training and inference logits. Each sentence is reversed within its own length, 
+    # so the padding of a shorter sentence in a batch stays after it
+    training_logits, inference_logits = seq2seq_model(tf.reverse_sequence(inputs, inputs_length, 1),
                                                       targets, 
                                                       keep_prob,   
                                                       inputs_length,
@@ -637,39 +1171,71 @@ def build_graph(keep_prob, rnn_size, num_layers, batch_size, learning_rate, embe
                                                       vocab_to_int,
                                                       batch_size,
                                                       embedding_size,
-                                                      direction)
-
-    # Create tensors for the training logits and inference logits
-    training_logits = tf.identity(training_logits.rnn_output, 'logits')
+                                                      direction,
+                                                      inference_only,
+                                                      beam_width,
+                                                      length_penalty,
+                                                      fused_lstm)
 
     with tf.name_scope('predictions'):
-        predictions = tf.identity(inference_logits.sample_id, name='predictions')
-        tf.summary.histogram('predictions', predictions)
-
-    # Create the weights for sequence_loss
-    masks = tf.sequence_mask(targets_length, max_target_length, dtype=tf.float32, name='masks')
+        if beam_search:
+            # The beams of every sentence are sorted by their scores, best first
+            beam_predictions = tf.identity(inference_logits[0], name='beam_predictions')
+            beam_scores = tf.identity(inference_logits[1], name='beam_scores')
+            predictions = tf.identity(beam_predictions[:, 0], name='predictions')
+        else:
+            beam_predictions, beam_scores = None, None
+            predictions = tf.identity(inference_logits.sample_id, name='predictions')
+        if not inference_only:
+            predictions_summary = tf.summary.histogram('predictions', predictions)
+
+    if inference_only:
+        # Without the loss and the optimizer only the model weights are restored, not the Adam slots
+        cost, merged, diagnostics, train_op, optimizer = None, None, None, None, None
+        snapshot, snapshot_saver = None, None
+    else:
+        # Create tensors for the training logits and inference logits
+        training_logits = tf.identity(training_logits.rnn_output, 'logits')
+
+        # Create the weights for sequence_loss
+        masks = tf.sequence_mask(targets_length, max_target_length, dtype=tf.float32, name='masks')
+        
+        with tf.name_scope("cost"):
+            # Loss function
+            cost = tf.contrib.seq2seq.sequence_loss(training_logits, 
+                                                    targets, 
+                                                    masks)
+            cost_summary = tf.summary.scalar('cost', cost)
+
+        with tf.name_scope("optimze"):
+            optimizer = tf.train.AdamOptimizer(learning_rate)
+
+            # Gradient Clipping
+            gradients = optimizer.compute_gradients(cost)
+            capped_gradients = [(tf.clip_by_value(grad, -5., 5.), var) for grad, var in gradients if grad is not None]
+            train_op = optimizer.apply_gradients(capped_gradients)
+
+        # Keep the cheap summaries that are written every batch apart from the ones that run the inference decoder
+        merged = tf.summary.merge([cost_summary])
+        diagnostics = tf.summary.merge([predictions_summary])
+        
+        # Copies of the variables, which are written to a checkpoint while the training goes on. They are saved
+        # under the names of the variables they copy, and as local variables the other savers leave them out.
+        with tf.name_scope("snapshot"):
+            variables = tf.global_variables()
+            shadows = [tf.Variable(tf.zeros(variable.get_shape(), variable.dtype.base_dtype), trainable=False,
+                                   collections=[tf.GraphKeys.LOCAL_VARIABLES]) for variable in variables]
+            snapshot = tf.group(*[tf.assign(shadow, variable) for shadow, variable in zip(shadows, variables)])
+            snapshot_saver = tf.train.Saver({variable.op.name: shadow for variable, shadow in zip(variables, shadows)})
     
-    with tf.name_scope("cost"):
-        # Loss function
-        cost = tf.contrib.seq2seq.sequence_loss(training_logits, 
-                                                targets, 
-                                                masks)
-        tf.summary.scalar('cost', cost)
-
-    with tf.name_scope("optimze"):
-        optimizer = tf.train.AdamOptimizer(learning_rate)
-
-        # Gradient Clipping
-        gradients = optimizer.compute_gradients(cost)
-        capped_gradients = [(tf.clip_by_value(grad, -5., 5.), var) for grad, var in gradients if grad is not None]
-        train_op = optimizer.apply_gradients(capped_gradients)
-
-    # Merge all of the summaries
-    merged = tf.summary.merge_all()    
+    # One saver for all of the variables of the graph, to restore them
+    saver = tf.train.Saver()
 
     # Export the nodes 
     export_nodes = ['inputs', 'targets', 'keep_prob', 'cost', 'inputs_length', 'targets_length',
-                    'predictions', 'merged', 'train_op','optimizer']
+                    'predictions', 'merged', 'diagnostics', 'train_op','optimizer',
+                    'beam_width', 'length_penalty', 'beam_predictions', 'beam_scores',
+                    'saver', 'snapshot', 'snapshot_saver']
     Graph = namedtuple('Graph', export_nodes)
     local_dict = locals()
     graph = Graph(*[local_dict[each] for each in export_nodes])
@@ -679,14 +1245,136 @@ def build_graph(keep_prob, rnn_size, num_layers, batch_size, learning_rate, embe
 
 # ### Training the Model
 
+# In[ ]:
+
+
+# Make the validation batches once: a fixed sample of size testing sentences with fixed mistakes, sorted by 
+# length, so that every check measures the same sentences and no batch is made again. None takes all of them.
+def make_validation_batches(sentences, ids, size, batch_size, threshold, seed):
+    rng = np.random.RandomState(seed)
+    if size is not None and size < len(ids):
+        ids = rng.choice(ids, size, replace=False)
+    ids = ids[np.argsort(sentences.lengths[ids], kind='mergesort')]
+    return [make_batch([sentences[i] for i in ids[start_i:start_i + batch_size]], threshold, rng)
+            for start_i in range(0, len(ids), batch_size)]
+
+
+# The mean loss of the model on batches, running only the cost without dropout
+def validation_loss(sess, model, batches):
+    loss = 0
+    n_batches = 0
+    for input_batch, target_batch, input_length, target_length in batches:
+        loss += sess.run(model.cost, {model.inputs: input_batch,
+                                      model.targets: target_batch,
+                                      model.inputs_length: input_length,
+                                      model.targets_length: target_length,
+                                      model.keep_prob: 1})
+        n_batches += 1
+    return loss / n_batches
+
+
+# A summary of a loss computed outside of the graph, under the tag of the cost summary
+def loss_summary(loss, tag='cost/cost'):
+    return tf.Summary(value=[tf.Summary.Value(tag=tag, simple_value=loss)])
+
+
+# In[ ]:
+
+
+# The hash of the vocabulary a checkpoint was trained with, kept in the training state written next to it
+def checkpoint_vocab_hash(checkpoint):
+    if not os.path.exists(checkpoint + '.json'):
+        return None
+    with open(checkpoint + '.json') as f:
+        return json.load(f).get('vocab_hash')
+
+
+# Refuse a model that was not trained with vocab_to_int, as the ids of its text would not be the ones it knows
+def check_vocab_hash(model_vocab_hash, model_path):
+    if model_vocab_hash != vocab_hash(vocab_to_int):
+        raise ValueError("{} was not trained with the vocabulary in {}.".format(model_path, vocab_path))
+
+
+# Write the checkpoints of a training run in the background. save only copies the variables on the training 
+# thread, and the copy is written as ./{log_string}.ckpt-{iteration} while the training goes on. The files 
+# are written to a temporary directory and moved into place before the checkpoint is listed in the state file
+# ./{log_string}.checkpoint, so a listed checkpoint is always complete. The max_to_keep latest are kept.
+# The state of the training loop is written next to each checkpoint as {checkpoint}.json, and the state at the 
+# last check, with or without a checkpoint, as ./{log_string}.state.json.
+class CheckpointWriter():
+    def __init__(self, model, log_string, max_to_keep):
+        self.model = model
+        self.log_string = log_string
+        self.max_to_keep = max_to_keep
+        self.latest_filename = log_string + '.checkpoint'
+        self.state_path = log_string + '.state.json'
+        state = tf.train.get_checkpoint_state('./', self.latest_filename)
+        self.checkpoints = [os.path.normpath(path) for path in state.all_model_checkpoint_paths] if state else []
+        self.thread = None
+        self.error = None
+
+    def save(self, sess, iteration, training_state):
+        # The previous checkpoint has to be written before its copy is overwritten
+        self.wait()
+        sess.run(self.model.snapshot)
+        self.thread = threading.Thread(target=self.write, args=(sess, iteration, training_state))
+        self.thread.start()
+
+    def write(self, sess, iteration, training_state):
+        try:
+            checkpoint = '{}.ckpt-{}'.format(self.log_string, iteration)
+            tmp_dir = tempfile.mkdtemp(prefix=self.log_string + '.', dir='./')
+            try:
+                tmp_checkpoint = self.model.snapshot_saver.save(sess, join(tmp_dir, 'model.ckpt'), 
+                                                                write_meta_graph=False, write_state=False)
+                with open(tmp_checkpoint + '.json', 'w') as f:
+                    json.dump(training_state, f)
+                for tmp_file in glob(tmp_checkpoint + '.*'):
+                    os.replace(tmp_file, checkpoint + tmp_file[len(tmp_checkpoint):])
+            finally:
+                shutil.rmtree(tmp_dir)
+            
+            checkpoints = [path for path in self.checkpoints if path != checkpoint] + [checkpoint]
+            self.checkpoints = checkpoints[-self.max_to_keep:]
+            tf.train.update_checkpoint_state('./', checkpoint, self.checkpoints, self.latest_filename)
+            for old_checkpoint in checkpoints[:-self.max_to_keep]:
+                for old_file in glob(old_checkpoint + '.*'):
+                    os.remove(old_file)
+        except Exception as e:
+            self.error = e
+
+    # The state is small, so it is written on the training thread, to a temporary file first
+    def save_state(self, training_state):
+        with open(self.state_path + '.tmp', 'w') as f:
+            json.dump(training_state, f)
+        os.replace(self.state_path + '.tmp', self.state_path)
+
+    def load_state(self):
+        if not os.path.exists(self.state_path):
+            return None
+        with open(self.state_path) as f:
+            return json.load(f)
+
+    # Wait for the checkpoint being written, and raise its error if it failed
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+
 # In[37]:
 
 
-# Train the RNN
+# Train the RNN. With resume_training a run that has a checkpoint continues with its weights, at the batch after 
+# the last check of the run and with the checks that did not improve since it. A run that has stopped is not 
+# trained again, and a run whose checkpoint has another vocabulary starts again from the beginning.
 def train(model, epochs, log_string):   
     
     with tf.Session() as sess:
-        sess.run(tf.global_variables_initializer())
+        checkpoint_writer = CheckpointWriter(model, log_string, checkpoints_to_keep)
 
         # Used to determine when to stop the training early
         testing_loss_summary = []
@@ -698,7 +1386,17 @@ def train(model, epochs, log_string):
         stop_early = 0 
         stop = 3 # If the batch_loss_testing does not decrease in 3 consecutive checks, stop training
         per_epoch = 3 # Test the model 3 times per epoch
-        testing_check = (len(training_sorted)//batch_size//per_epoch)-1
+        first_epoch, first_batch = 1, 0
+
+        # The state of the training loop, saved at every check
+        def loop_state(epoch_i, batch_i, stopped):
+            return {'iteration': iteration, 
+                    'epoch_i': epoch_i, 
+                    'batch_i': batch_i,
+                    'testing_loss_summary': [float(testing_loss) for testing_loss in testing_loss_summary],
+                    'stop_early': stop_early,
+                    'stopped': stopped,
+                    'vocab_hash': vocab_hash(vocab_to_int)}
 
         print()
         print("Training Model: {}".format(log_string))
@@ -706,22 +1404,67 @@ def train(model, epochs, log_string):
         train_writer = tf.summary.FileWriter('./logs/train/{}'.format(log_string), sess.graph)
         test_writer = tf.summary.FileWriter('./logs/test/{}'.format(log_string))
 
-        for epoch_i in range(1, epochs+1): 
+        checkpoint = tf.train.latest_checkpoint('./', checkpoint_writer.latest_filename)
+        if resume_training and checkpoint is not None and checkpoint_vocab_hash(checkpoint) != vocab_hash(vocab_to_int):
+            print("{} was trained with another vocabulary, training from the beginning.".format(checkpoint))
+            checkpoint = None
+        
+        if resume_training and checkpoint is not None:
+            # The weights and the Adam slots and step counts are all in the checkpoint
+            model.saver.restore(sess, checkpoint)
+            with open(checkpoint + '.json') as f:
+                training_state = json.load(f)
+            
+            # The checks after the checkpoint did not improve on its weights, but they still count
+            last_state = checkpoint_writer.load_state()
+            if last_state is not None and last_state['iteration'] >= training_state['iteration']:
+                training_state = last_state
+            if training_state.get('stopped', False):
+                print("{} has already stopped training.".format(log_string))
+                return
+            
+            iteration = training_state['iteration']
+            testing_loss_summary = training_state['testing_loss_summary']
+            stop_early = training_state['stop_early']
+            first_epoch, first_batch = training_state['epoch_i'], training_state['batch_i'] + 1
+            print("Resuming from {}, epoch {} batch {}.".format(checkpoint, first_epoch, first_batch))
+            
+            # Tell TensorBoard to drop what the stopped run logged after the checkpoint
+            for writer in [train_writer, test_writer]:
+                writer.add_session_log(tf.SessionLog(status=tf.SessionLog.START), iteration)
+        else:
+            sess.run(tf.global_variables_initializer())
+        
+        # The validation batches are made once and checked per_epoch times per epoch
+        validation_batches = make_validation_batches(good_sentences, testing_sorted, validation_size, 
+                                                     batch_size, threshold, noise_seed)
+
+        for epoch_i in range(first_epoch, epochs+1): 
             batch_loss = 0
             batch_time = 0
             
+            # New batches of similar lengths for every epoch, the same ones again when an epoch is resumed
+            batches = bucket_batches(training_buckets, batch_size, token_budget, 
+                                     np.random.RandomState([noise_seed, epoch_i]))
+            testing_check = max(len(batches)//per_epoch - 1, 1)
+            
             for batch_i, (input_batch, target_batch, input_length, target_length) in enumerate(
-                    get_batches(training_sorted, batch_size, threshold)):
+                    prefetch_batches(good_sentences, batches, threshold, noise_seed, epoch_i, 
+                                     batch_workers, batch_prefetch, first_batch), first_batch):
                 start_time = time.time()
 
-                summary, loss, _ = sess.run([model.merged,
-                                             model.cost, 
-                                             model.train_op], 
-                                             {model.inputs: input_batch,
-                                              model.targets: target_batch,
-                                              model.inputs_length: input_length,
-                                              model.targets_length: target_length,
-                                              model.keep_prob: keep_probability})
+                feed = {model.inputs: input_batch,
+                        model.targets: target_batch,
+                        model.inputs_length: input_length,
+                        model.targets_length: target_length,
+                        model.keep_prob: keep_probability}
+
+                if log_train_summaries:
+                    summary, loss, _ = sess.run([model.merged,
+                                                 model.cost, 
+                                                 model.train_op], feed)
+                else:
+                    loss, _ = sess.run([model.cost, model.train_op], feed)
 
 
                 batch_loss += loss
@@ -729,7 +1472,12 @@ def train(model, epochs, log_string):
                 batch_time += end_time - start_time
 
                 # Record the progress of training
-                train_writer.add_summary(summary, iteration)
+                if log_train_summaries:
+                    train_writer.add_summary(summary, iteration)
+
+                # The predictions histogram needs a full inference decode, so it is only recorded now and then
+                if iteration % diagnostics_step == 0:
+                    train_writer.add_summary(sess.run(model.diagnostics, feed), iteration)
 
                 iteration += 1
 
@@ -738,7 +1486,7 @@ def train(model, epochs, log_string):
                           .format(epoch_i,
                                   epochs, 
                                   batch_i, 
-                                  len(training_sorted) // batch_size, 
+                                  len(batches), 
                                   batch_loss / display_step, 
                                   batch_time))
                     batch_loss = 0
@@ -746,51 +1494,52 @@ def train(model, epochs, log_string):
 
                 #### Testing ####
                 if batch_i % testing_check == 0 and batch_i > 0:
-                    batch_loss_testing = 0
-                    batch_time_testing = 0
-                    for batch_i, (input_batch, target_batch, input_length, target_length) in enumerate(
-                            get_batches(testing_sorted, batch_size, threshold)):
-                        start_time_testing = time.time()
-                        summary, loss = sess.run([model.merged,
-                                                  model.cost], 
-                                                     {model.inputs: input_batch,
-                                                      model.targets: target_batch,
-                                                      model.inputs_length: input_length,
-                                                      model.targets_length: target_length,
-                                                      model.keep_prob: 1})
-
-                        batch_loss_testing += loss
-                        end_time_testing = time.time()
-                        batch_time_testing += end_time_testing - start_time_testing
-
-                        # Record the progress of testing
-                        test_writer.add_summary(summary, iteration)
-
-                    n_batches_testing = batch_i + 1
+                    start_time_testing = time.time()
+                    batch_loss_testing = validation_loss(sess, model, validation_batches)
+                    batch_time_testing = time.time() - start_time_testing
+
+                    # Record the progress of testing
+                    test_writer.add_summary(loss_summary(batch_loss_testing), iteration)
                     print('Testing Loss: {:>6.3f}, Seconds: {:>4.2f}'
-                          .format(batch_loss_testing / n_batches_testing, 
+                          .format(batch_loss_testing, 
                                   batch_time_testing))
-                    
-                    batch_time_testing = 0
 
                     # If the batch_loss_testing is at a new minimum, save the model
                     testing_loss_summary.append(batch_loss_testing)
                     if batch_loss_testing <= min(testing_loss_summary):
                         print('New Record!') 
                         stop_early = 0
-                        checkpoint = "./{}.ckpt".format(log_string)
-                        saver = tf.train.Saver()
-                        saver.save(sess, checkpoint)
+                        checkpoint_writer.save(sess, iteration, loop_state(epoch_i, batch_i, False))
+                        checkpoint_writer.save_state(loop_state(epoch_i, batch_i, False))
 
                     else:
                         print("No Improvement.")
                         stop_early += 1
+                        checkpoint_writer.save_state(loop_state(epoch_i, batch_i, stop_early == stop))
                         if stop_early == stop:
                             break
 
+            first_batch = 0
+            
+            # The whole testing set with new mistakes, only reported as it does not decide the early stopping
+            if full_validation:
+                start_time_testing = time.time()
+                full_loss_testing = validation_loss(sess, model, 
+                                                    get_batches(good_sentences, testing_sorted, batch_size, threshold))
+                test_writer.add_summary(loss_summary(full_loss_testing, 'cost/full'), iteration)
+                print('Full Testing Loss: {:>6.3f}, Seconds: {:>4.2f}'
+                      .format(full_loss_testing, 
+                              time.time() - start_time_testing))
+            
             if stop_early == stop:
                 print("Stopping Training.")
                 break
+        else:
+            # All of the epochs are trained
+            checkpoint_writer.save_state(loop_state(epochs, None, True))
+        
+        # The last checkpoint has to be written before the session is closed
+        checkpoint_writer.wait()
 
 
 # In[38]:
@@ -804,7 +1553,7 @@ for keep_probability in [0.75]:
                                                     num_layers,
                                                     threshold) 
             model = build_graph(keep_probability, rnn_size, num_layers, batch_size, 
-                                learning_rate, embedding_size, direction)
+                                learning_rate, embedding_size, direction, fused_lstm=fused_lstm)
             train(model, epochs, log_string)
 
 
@@ -817,7 +1566,294 @@ for keep_probability in [0.75]:
 def text_to_ints(text):  
     
     text = clean_text(text)
-    return [vocab_to_int[word] for word in text]
+    return clean_text_to_ints(text)
+
+
+# Convert a text that was already cleaned. clean_text is not run again, as a second pass can change the text 
+# ('aa00' is cleaned to 'a0' and then to '').
+def clean_text_to_ints(text):
+    return [vocab_to_int[character] for character in text]
+
+
+# In[ ]:
+
+
+# Convert the predictions of the model back to text, stopping at the first <EOS>
+def ints_to_text(answer_logits):
+    
+    text = []
+    for i in answer_logits:
+        if i == vocab_to_int['<EOS>']:
+            break
+        if i != vocab_to_int['<PAD>']:
+            text.append(int_to_vocab[i])
+    return "".join(text)
+
+
+# In[ ]:
+
+
+# Feed a batch of texts to the inference nodes of the model
+def inference_feed(model, texts):
+    
+    pad_texts = pad_sentence_batch(texts)
+    
+    # Each text is encoded and attended to only up to its own length, so the padding added for the longer 
+    # texts of the batch does not change its correction, as in the training batches of a single length
+    return {model.inputs: pad_texts, 
+            model.inputs_length: [len(text) for text in texts],
+            model.targets_length: [len(text)+1 for text in texts], 
+            model.keep_prob: 1.0}
+
+
+# Correct a list of different sentences, packing up to batch_size of them into each sess.run.
+# With cleaned the sentences are taken as they are, as cleaned by clean_text.
+def correct_batch(sess, model, sentences, cleaned=False):
+    
+    # Sentences of about the same length are batched together, so there is little padding to decode
+    order = sorted(range(len(sentences)), key=lambda i: len(sentences[i]))
+    answers = [None] * len(sentences)
+    for start_i in range(0, len(order), batch_size):
+        batch = order[start_i:start_i + batch_size]
+        texts = [clean_text_to_ints(sentences[i]) if cleaned else text_to_ints(sentences[i]) for i in batch]
+        answer_logits = sess.run(model.predictions, inference_feed(model, texts))
+        # A sentence stopped at its length has no <EOS>, the rest of its row is filled with 0s
+        for i, text, answer in zip(batch, texts, answer_logits):
+            answers[i] = ints_to_text(answer[:len(text)+1])
+    return answers
+
+
+# Correct a list of sentences with beam search, giving the beam_width best corrections of each with their scores
+def correct_top_k(sess, model, sentences, beam_width, length_penalty):
+    
+    # Sentences of about the same length are batched together, as in correct_batch
+    order = sorted(range(len(sentences)), key=lambda i: len(sentences[i]))
+    corrections = [None] * len(sentences)
+    for start_i in range(0, len(order), batch_size):
+        batch = order[start_i:start_i + batch_size]
+        texts = [text_to_ints(sentences[i]) for i in batch]
+        feed = inference_feed(model, texts)
+        feed[model.beam_width] = beam_width
+        feed[model.length_penalty] = length_penalty
+        
+        beam_logits, beam_scores = sess.run([model.beam_predictions, model.beam_scores], feed)
+        for i, beams, scores in zip(batch, beam_logits, beam_scores):
+            corrections[i] = [(ints_to_text(beam), score) for beam, score in zip(beams, scores)]
+    return corrections
+
+
+# In[ ]:
+
+
+# The nodes needed to correct sentences with an inference only or frozen graph
+InferenceGraph = namedtuple('InferenceGraph', ['inputs', 'keep_prob', 'inputs_length', 'targets_length', 
+                                               'predictions', 'beam_width', 'length_penalty', 
+                                               'beam_predictions', 'beam_scores'])
+
+
+# In[ ]:
+
+
+# Write a frozen graph with only the encoder, the inference decoder and the predictions
+def export_inference_model(checkpoint, export_path, beam_search=False):
+    
+    # The frozen graph keeps the hash of vocab_to_int, so it has to be the vocabulary of the checkpoint
+    check_vocab_hash(checkpoint_vocab_hash(checkpoint), checkpoint)
+    
+    model = build_graph(keep_probability, rnn_size, num_layers, batch_size, 
+                        learning_rate, embedding_size, direction, inference_only=True, beam_search=beam_search,
+                        fused_lstm=fused_lstm)
+    
+    outputs = [model.predictions]
+    if beam_search:
+        outputs += [model.beam_predictions, model.beam_scores]
+    
+    with tf.Session() as sess:
+        # Only the model weights are in this graph, so the Adam slots are not loaded
+        model.saver.restore(sess, checkpoint)
+        
+        graph_def = tf.graph_util.convert_variables_to_constants(sess, 
+                                                                 sess.graph.as_graph_def(), 
+                                                                 [output.op.name for output in outputs] + 
+                                                                 ['vocab_hash'])
+    
+    with tf.gfile.GFile(export_path, 'wb') as f:
+        f.write(graph_def.SerializeToString())
+    print("Exported {} nodes to {}.".format(len(graph_def.node), export_path))
+
+
+# In[ ]:
+
+
+# Load a frozen graph written by export_inference_model into a new graph
+def load_inference_model(export_path):
+    
+    graph_def = tf.GraphDef()
+    with tf.gfile.GFile(export_path, 'rb') as f:
+        graph_def.ParseFromString(f.read())
+    
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.import_graph_def(graph_def, name='')
+    
+    # The beam search nodes are only there when the model was exported with beam_search
+    beam_search = 'beam_width' in [node.name for node in graph_def.node]
+    def beam_search_tensor(name):
+        return graph.get_tensor_by_name(name) if beam_search else None
+    
+    model = InferenceGraph(graph.get_tensor_by_name('inputs/inputs:0'),
+                           graph.get_tensor_by_name('keep_prob:0'),
+                           graph.get_tensor_by_name('inputs_length:0'),
+                           graph.get_tensor_by_name('targets_length:0'),
+                           graph.get_tensor_by_name('predictions/predictions:0'),
+                           beam_search_tensor('beam_width:0'),
+                           beam_search_tensor('length_penalty:0'),
+                           beam_search_tensor('predictions/beam_predictions:0'),
+                           beam_search_tensor('predictions/beam_scores:0'))
+    return graph, model
+
+
+# In[ ]:
+
+
+# Split a cleaned text at its spaces into windows of up to window_length characters, the longest sentences 
+# the model was trained with. A single word longer than that is a window of its own.
+def text_windows(text, window_length):
+    windows = []
+    window = ''
+    for word in text.split():
+        if window and len(window) + 1 + len(word) > window_length:
+            windows.append(window)
+            window = word
+        else:
+            window = window + ' ' + word if window else word
+    if window:
+        windows.append(window)
+    return windows
+
+
+# A window is already correct if all of its words are known and all of its characters are in the vocabulary
+def is_known_window(window, lexicon):
+    return (all(word in lexicon for word in lexicon_word.findall(window)) and 
+            all(character in vocab_to_int for character in window))
+
+
+# In[ ]:
+
+
+# Least recently used cache of corrections, bounded by the number of entries and by the memory of their text.
+# The keys are (version, cleaned text), so a cache can be shared by correctors of different models.
+class CorrectionCache():
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            answer = self.entries.get(key)
+            if answer is None:
+                self.misses += 1
+            else:
+                self.entries.move_to_end(key)
+                self.hits += 1
+            return answer
+
+    def put(self, key, answer):
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = answer
+            self.size += sys.getsizeof(key[1]) + sys.getsizeof(answer)
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                old_key, old_answer = self.entries.popitem(last=False)
+                self.size -= sys.getsizeof(old_key[1]) + sys.getsizeof(old_answer)
+
+
+# In[ ]:
+
+
+# Build the graph and restore the checkpoint once, then keep the session open to correct many requests.
+# A frozen graph from export_inference_model (a .pb file) can be used in place of a checkpoint.
+# With beam_search the decoder is built for beam search, which is greedy decoding with the default width of 1.
+# Sentences that were corrected before are answered from the cache without running the decoder.
+# Long sentences are corrected in windows, and only the windows with a word that is not in the lexicon are decoded.
+class SpellCorrector():
+    def __init__(self, checkpoint, beam_search=False, cache=None, lexicon=lexicon, window_length=max_length):
+        # The ids of the text must be the ones the model was trained with, so the hash of its vocabulary, 
+        # kept in the frozen graph or next to the checkpoint, has to be the one of vocab_to_int
+        if checkpoint.endswith('.pb'):
+            self.graph, self.model = load_inference_model(checkpoint)
+            self.sess = tf.Session(graph=self.graph)
+            
+            if 'vocab_hash' in [op.name for op in self.graph.get_operations()]:
+                check_vocab_hash(self.sess.run('vocab_hash:0').decode('utf_8'), checkpoint)
+            else:
+                check_vocab_hash(None, checkpoint)
+        else:
+            check_vocab_hash(checkpoint_vocab_hash(checkpoint), checkpoint)
+
+            self.model = build_graph(keep_probability, rnn_size, num_layers, batch_size, 
+                                     learning_rate, embedding_size, direction, inference_only=True,
+                                     beam_search=beam_search, fused_lstm=fused_lstm)
+            self.graph = tf.get_default_graph()
+            self.sess = tf.Session(graph=self.graph)
+            
+            # Load saved model
+            self.model.saver.restore(self.sess, checkpoint)
+        
+        # Nothing else will be added to the graph, this also catches accidental graph growth per request
+        self.graph.finalize()
+        
+        # The cached corrections belong to this model and vocabulary
+        self.version = '{}:{}'.format(checkpoint, vocab_hash(vocab_to_int))
+        self.cache = cache if cache is not None else CorrectionCache(100000, 64 * 1024 * 1024)
+        self.lexicon = lexicon
+        self.window_length = window_length
+
+    def correct(self, text):
+        return self.correct_batch([text])[0]
+
+    def correct_batch(self, texts):
+        windows = [text_windows(clean_text(text), self.window_length) for text in texts]
+        
+        # Each window that needs the decoder is looked up in the cache, and decoded only once if it is missing
+        answers = {}
+        missing = OrderedDict()
+        for window in itertools.chain(*windows):
+            if window in answers or window in missing or is_known_window(window, self.lexicon):
+                continue
+            answer = self.cache.get((self.version, window))
+            if answer is None:
+                missing[window] = None
+            else:
+                answers[window] = answer
+        if len(missing) > 0:
+            for window, answer in zip(missing, correct_batch(self.sess, self.model, list(missing), cleaned=True)):
+                self.cache.put((self.version, window), answer)
+                answers[window] = answer
+        
+        # The known windows are kept as they are
+        return [' '.join(answers.get(window, window) for window in text) for text in windows]
+
+    # Correct a document split into sentences with the same '. ' rule as the training sentences.
+    # All of its sentences are corrected together, and joined back in their order.
+    def correct_document(self, document):
+        pieces = clean_text(document).split('. ')
+        sentences = [piece + '.' for piece in pieces[:-1]] + pieces[-1:]
+        return ' '.join(answer for answer in self.correct_batch(sentences) if answer)
+
+    def correct_top_k(self, texts, beam_width, length_penalty=0.0):
+        if self.model.beam_predictions is None:
+            raise ValueError("The model was not built for beam search.")
+        return correct_top_k(self.sess, self.model, texts, beam_width, length_penalty)
+
+    def close(self):
+        self.sess.close()
 
 
 # ### example01
@@ -825,34 +1861,31 @@ def text_to_ints(text):
 # In[40]:
 
 
-# Create your own sentence or use one from the dataset
-text = "The first days of her existence in th country were vrey hard for Dolly.."
-text = text_to_ints(text)
+# Create your own sentences or use some from the dataset
+texts = ["The first days of her existence in th country were vrey hard for Dolly..",
+         "Thi is really something impressiv thaat we should look into right away!"]
 
-checkpoint = "./kp=0.75,nl=2,th=0.95.ckpt"
+# The latest checkpoint of the training run
+checkpoint = tf.train.latest_checkpoint('./', 'kp=0.75,nl=2,th=0.95.checkpoint')
 
-model = build_graph(keep_probability, rnn_size, num_layers, batch_size, learning_rate, embedding_size, direction) 
+# Freeze the inference part of the model so it can be served without the training graph
+export_path = "./kp=0.75,nl=2,th=0.95.pb"
+export_inference_model(checkpoint, export_path, beam_search=True)
 
-with tf.Session() as sess:
-    # Load saved model
-    saver = tf.train.Saver()
-    saver.restore(sess, checkpoint)
-    
-    #Multiply by batch_size to match the model's input parameters
-    answer_logits = sess.run(model.predictions, {model.inputs: [text]*batch_size, 
-                                                 model.inputs_length: [len(text)]*batch_size,
-                                                 model.targets_length: [len(text)+1], 
-                                                 model.keep_prob: [1.0]})[0]
+# The model is loaded once and reused for every correction below
+corrector = SpellCorrector(export_path)
+
+# All of the sentences are corrected together in one batch
+answers = corrector.correct_batch(texts)
 
 
 # In[41]:
 
 
-# Remove the padding from the generated sentence
-pad = vocab_to_int["<PAD>"] 
 # Text
 print('\nText')
-print('  Input Words: {}'.format("".join([int_to_vocab[i] for i in text])))
+for text in texts:
+    print('  Input Words: {}'.format("".join([int_to_vocab[i] for i in text_to_ints(text)])))
 
 
 # In[42]:
@@ -860,7 +1893,8 @@ print('  Input Words: {}'.format("".join([int_to_vocab[i] for i in text])))
 
 # Summary
 print('\nSummary')
-print('Response Words: {}'.format("".join([int_to_vocab[i] for i in answer_logits if i != pad])))
+for answer in answers:
+    print('Response Words: {}'.format(answer))
 
 
 # ### example02
@@ -868,42 +1902,217 @@ print('Response Words: {}'.format("".join([int_to_vocab[i] for i in answer_logit
 # In[43]:
 
 
-# Create your own sentence or use one from the dataset
+# Correct a single sentence with the same resident model
 text = "Thi is really something impressiv thaat we should look into right away!"
-text = text_to_ints(text)
+print('Response Words: {}'.format(corrector.correct(text)))
 
-checkpoint = "./kp=0.75,nl=2,th=0.95.ckpt"
+# The second time the sentence is answered from the cache
+corrector.correct(text)
+print('Cache hits: {}, misses: {}'.format(corrector.cache.hits, corrector.cache.misses))
 
-model = build_graph(keep_probability, rnn_size, num_layers, batch_size, learning_rate, embedding_size, direction) 
 
-with tf.Session() as sess:
-    # Load saved model
-    saver = tf.train.Saver()
-    saver.restore(sess, checkpoint)
-    
-    #Multiply by batch_size to match the model's input parameters
-    answer_logits = sess.run(model.predictions, {model.inputs: [text]*batch_size, 
-                                                 model.inputs_length: [len(text)]*batch_size,
-                                                 model.targets_length: [len(text)+1], 
-                                                 model.keep_prob: [1.0]})[0]
+# In[ ]:
 
 
-# In[44]:
+# Correct a longer text a sentence at a time
+document = ("Thi is really something impressiv thaat we should look into right away. "
+            "Waht is the most popular type of coffe? I didn't gete it all. "
+            "Her mom asked her to clean her roum.")
+print('Response Words: {}'.format(corrector.correct_document(document)))
 
 
-# Remove the padding from the generated sentence
-pad = vocab_to_int["<PAD>"] 
-# Text
-print('\nText')
-print('  Input Words: {}'.format("".join([int_to_vocab[i] for i in text])))
+# In[ ]:
 
 
-# In[45]:
+# The 5 best corrections of the same sentence with their scores, from the same model
+for answer, score in corrector.correct_top_k([text], beam_width=5, length_penalty=0.6)[0]:
+    print('{:>8.3f} {}'.format(score, answer))
 
 
-# Summary
-print('\nSummary')
-print('Response Words: {}'.format("".join([int_to_vocab[i] for i in answer_logits if i != pad])))
+# ## Serving the Corrector
+
+# In[ ]:
+
+
+# Collect the sentences of concurrent requests into batches for the corrector. A batch is decoded when it has 
+# max_batch_size sentences, or max_wait seconds after its first sentence came in, so a sentence waits at most 
+# max_wait seconds longer than it would alone. Only the thread of the batcher runs the session.
+class MicroBatcher():
+    def __init__(self, corrector, max_batch_size, max_wait):
+        self.corrector = corrector
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.batch_sizes = Counter()
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # A text with a character that is not in the vocabulary is refused before it joins a batch
+    def correct_many(self, texts):
+        for text in texts:
+            unknown = set(clean_text(text)) - vocab_to_int.keys()
+            if unknown:
+                raise ValueError("{!r} has characters that are not in the vocabulary: {}".format(
+                    text, "".join(sorted(unknown))))
+        futures = []
+        for text in texts:
+            future = Future()
+            self.requests.put((text, future))
+            futures.append(future)
+        return [future.result() for future in futures]
+
+    def run(self):
+        while not self.closed:
+            batch = [self.requests.get()]
+            deadline = time.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                try:
+                    batch.append(self.requests.get(timeout=max(0, deadline - time.time())))
+                except queue.Empty:
+                    break
+            
+            # close puts None in the queue to wake the thread up
+            batch = [request for request in batch if request is not None]
+            if len(batch) == 0:
+                continue
+            self.batch_sizes[len(batch)] += 1
+            try:
+                answers = self.corrector.correct_batch([text for text, _ in batch])
+            except Exception:
+                # Correct the texts one at a time, so that only the requests of a text that fails get its error
+                for text, future in batch:
+                    try:
+                        future.set_result(self.corrector.correct_batch([text])[0])
+                    except Exception as e:
+                        future.set_exception(e)
+            else:
+                for (_, future), answer in zip(batch, answers):
+                    future.set_result(answer)
+
+    def close(self):
+        self.closed = True
+        self.requests.put(None)
+        self.thread.join()
+
+
+# In[ ]:
+
+
+# Serve each connection in its own thread, they all wait on the same batcher. The backlog of 5 connections
+# of HTTPServer would reset the connections of clients beyond that.
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+# Answer a POST of {"texts": [...]} with {"corrections": [...]}, in the same order
+def make_server(batcher, port):
+    class CorrectionHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            try:
+                request = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf_8'))
+                status, answer = 200, {'corrections': batcher.correct_many(list(request['texts']))}
+            except (ValueError, KeyError, TypeError) as e:
+                status, answer = 400, {'error': repr(e)}
+            except Exception as e:
+                status, answer = 500, {'error': repr(e)}
+            body = json.dumps(answer, ensure_ascii=False).encode('utf_8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return ThreadingHTTPServer(('127.0.0.1', port), CorrectionHandler)
+
+
+# Send sentences to the server and return their corrections
+def post_texts(url, texts):
+    request = urllib.request.Request(url, json.dumps({'texts': texts}).encode('utf_8'), 
+                                     {'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read().decode('utf_8'))['corrections']
+
+
+# In[ ]:
+
+
+# The defaults of the server
+serve_port = 8000
+max_wait = 0.01 # Seconds the first sentence of a batch waits for more sentences
+
+batcher = MicroBatcher(corrector, batch_size, max_wait)
+server = make_server(batcher, serve_port)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+serve_url = 'http://127.0.0.1:{}/'.format(serve_port)
+
+print(post_texts(serve_url, [text]))
+
+
+# In[ ]:
+
+
+# Generate load with clients that each send requests of one sentence one after the other.
+# Sentences of the testing set are used, so that they are not answered from the cache, with mistakes 
+# added so that their windows are not known to the lexicon and all go through the decoder.
+# The sentences are taken in turn from the first one, going round again when there are not enough.
+def load_test(url, sentences, clients, requests_per_client, first_sentence=0):
+    latencies = []
+    failures = []
+    
+    def client(client_i):
+        for request_i in range(requests_per_client):
+            sentence_i = first_sentence + client_i * requests_per_client + request_i
+            start_time = time.time()
+            try:
+                post_texts(url, [sentences[sentence_i % len(sentences)]])
+            except Exception as e:
+                failures.append(e)
+                continue
+            latencies.append(time.time() - start_time)
+    
+    start_time = time.time()
+    threads = [threading.Thread(target=client, args=(client_i,)) for client_i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    total_time = time.time() - start_time
+    
+    if failures:
+        print("{:>3} clients: {} requests failed, the first with {!r}".format(clients, len(failures), failures[0]))
+    if latencies:
+        print("{:>3} clients: {:>7.1f} sentences/s, latency p50 {:>6.3f}s, p99 {:>6.3f}s".format(
+            clients, len(latencies) / total_time, np.percentile(latencies, 50), np.percentile(latencies, 99)))
+
+
+# Every run starts after the sentences of the one before, so it has its own while the testing set has enough
+load_rng = np.random.RandomState(noise_seed)
+load_sentences = ["".join([int_to_vocab[i] for i in noise_maker_batch(good_sentences[sentence_i].astype(np.int32), 
+                                                                       threshold, load_rng)]) 
+                  for sentence_i in testing[:5000]]
+print("{:.1%} of the load sentences are decoded.".format(
+    np.mean([not is_known_window(sentence, corrector.lexicon) for sentence in load_sentences])))
+load_start = 0
+for clients in [1, 8, 32, 128]:
+    batcher.batch_sizes.clear()
+    load_test(serve_url, load_sentences, clients, 20, load_start)
+    load_start += clients * 20
+    if batcher.batch_sizes:
+        print("      mean batch size {:.1f}".format(
+            sum(size * count for size, count in batcher.batch_sizes.items()) / sum(batcher.batch_sizes.values())))
+
+
+# In[ ]:
+
+
+server.shutdown()
+server.server_close()
+batcher.close()
 
 
 # ## Summary
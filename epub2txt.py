@@ -1,10 +1,13 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
+import io
 import os
 import sys
+import time
 import urllib.parse
 import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import xml.parsers.expat
 from os.path import isfile, join
@@ -13,6 +16,15 @@ import ntpath
 import html2text
 from glob import glob
 
+# Size of the pieces of a chapter fed to html2text
+CHUNK_SIZE = 64 * 1024
+
+# Parse xml given as a string or as a file, which is read in pieces
+def parseXml(parser, xml):
+  if hasattr(xml, "read"):
+    parser.ParseFile(xml)
+  else:
+    parser.Parse(xml, 1)
 
 class ContainerParser():
   def __init__(self,xmlcontent=None):
@@ -21,13 +33,12 @@ class ContainerParser():
 
   def startElement(self, name, attributes):
     if name == "rootfile":
-      self.buffer = ""
       self.rootfile = attributes["full-path"]
 
   def parseContainer(self):
     parser = xml.parsers.expat.ParserCreate()
     parser.StartElementHandler = self.startElement
-    parser.Parse(self.xml, 1)
+    parseXml(parser, self.xml)
     return self.rootfile
 
 class BookParser():
@@ -41,10 +52,10 @@ class BookParser():
 
   def startElement(self, name, attributes):
     if name == "dc:title":
-      self.buffer = ""
+      self.buffer = []
       self.inTitle = 1
     elif name == "dc:creator":
-      self.buffer = ""
+      self.buffer = []
       self.inAuthor = 1
     elif name == "item":
       if attributes["id"] == "ncx" or attributes["id"] == "toc" or attributes["id"] == "ncxtoc":
@@ -52,26 +63,26 @@ class BookParser():
 
   def characters(self, data):
     if self.inTitle:
-      self.buffer += data
+      self.buffer.append(data)
     elif self.inAuthor:
-      self.buffer += data
+      self.buffer.append(data)
 
   def endElement(self, name):
     if name == "dc:title":
       self.inTitle = 0
-      self.title = self.buffer
-      self.buffer = ""
+      self.title = "".join(self.buffer)
+      self.buffer = []
     elif name == "dc:creator":
       self.inAuthor = 0
-      self.author = self.buffer
-      self.buffer = ""
+      self.author = "".join(self.buffer)
+      self.buffer = []
 
   def parseBook(self):
     parser = xml.parsers.expat.ParserCreate()
     parser.StartElementHandler = self.startElement
     parser.EndElementHandler = self.endElement
     parser.CharacterDataHandler  = self.characters
-    parser.Parse(self.xml, 1)
+    parseXml(parser, self.xml)
     return self.title,self.author, self.ncx
 
 class NavPoint():
@@ -99,19 +110,19 @@ class TocParser():
     elif name == "content":
       self.currentNP.content = urllib.parse.unquote(attributes["src"])
     elif name == "text":
-      self.buffer = ""
+      self.buffer = []
       self.inText = 1
 
   def characters(self, data):
     if self.inText:
-      self.buffer += data
+      self.buffer.append(data)
 
   def endElement(self, name):
     if name == "navPoint":
       self.currentNP = self.stack.pop()
     elif name == "text":
       if self.inText and self.currentNP:
-        self.currentNP.text = self.buffer
+        self.currentNP.text = "".join(self.buffer)
       self.inText = 0
 
   def parseToc(self):
@@ -119,42 +130,117 @@ class TocParser():
     parser.StartElementHandler = self.startElement
     parser.EndElementHandler = self.endElement
     parser.CharacterDataHandler  = self.characters
-    parser.Parse(self.xml, 1)
+    parseXml(parser, self.xml)
     return self.toc
 
+class ChapterText(html2text.HTML2Text):
+  # Give the text to out as it is converted, instead of keeping all of it until close. The lines are
+  # not wrapped, as that would need the text of the whole chapter.
+  def __init__(self, out):
+    html2text.HTML2Text.__init__(self, bodywidth=0)
+    self.write = out
+
+  def outtextf(self, s):
+    if s:
+      self.lastWasNL = s[-1] == "\n"
+    # close puts the non-breaking spaces back in the text it keeps, which is empty here
+    self.write(s.replace("&nbsp_place_holder;", chr(160) if self.unicode_snob else " "))
+
 class epub2txt():
   def __init__(self,epubfile=None):
     self.epub = epubfile
 
+  # The text of the book in pieces, as it is converted
+  def iterText(self):
+    with zipfile.ZipFile(self.epub,"r") as file:
+      with file.open("META-INF/container.xml") as f:
+        rootfile = ContainerParser(f).parseContainer()
+      with file.open(rootfile) as f:
+        title, author, ncx = BookParser(f).parseBook()
+      ops = "/".join(rootfile.split("/")[:-1])
+      if ops != "":
+        ops = ops+"/"
+      with file.open(ops + ncx) as f:
+        toc = TocParser(f).parseToc()
+      # Several entries of the table of contents can point into the same chapter, which is only written once
+      written = set()
+      for t in toc:
+        yield "*"*(t.level+1) + " " + t.text + "\n"
+        yield t.text + "{{{%d\n"%(t.level+1)
+        chapter = ops + t.content.split("#")[0]
+        if chapter not in written:
+          written.add(chapter)
+          yield from self.iterChapter(file, chapter)
+        yield "\n"
+
   def convert(self):
-    print
-    "Processing {} ...".format(self.epub)
-    file=zipfile.ZipFile(self.epub,"r");
-    rootfile = ContainerParser(file.read("META-INF/container.xml")).parseContainer()
-    title, author, ncx = BookParser(file.read(rootfile)).parseBook()
-    ops = "/".join(rootfile.split("/")[:-1])
-    if ops != "":
-      ops = ops+"/"
-    toc = TocParser(file.read(ops + ncx)).parseToc()
-    fo = open(os.path.join("./books/text/" + ntpath.basename(self.epub) + ".txt"), "wb")
-    for t in toc:
-      html = file.read(ops + t.content.split("#")[0])
-      text = html2text.html2text(html.decode("utf-8"))
-      fo.write(("*"*(t.level+1) + " " + t.text + "\n").encode("utf-8"))
-      fo.write((t.text + "{{{%d\n"%(t.level+1)).encode("utf-8"))
-      fo.write((text + "\n").encode("utf-8"))
-    fo.close()
-    file.close()
+    # Write to a temporary file first, so a failed conversion never leaves a text that looks up to date
+    output = textPath(self.epub)
+    try:
+      with open(output + ".tmp", "w", encoding="utf-8") as fo:
+        for text in self.iterText():
+          fo.write(text)
+    except BaseException:
+      # The temporary file is missing when it could not be opened, which is the error to report
+      if os.path.exists(output + ".tmp"):
+        os.remove(output + ".tmp")
+      raise
+    os.replace(output + ".tmp", output)
+
+  # Convert a chapter in pieces, giving the text of each piece as soon as html2text has it. html2text adds a 
+  # space where a text is split between two pieces, so each piece ends with a tag and the rest is carried over.
+  def iterChapter(self, file, chapter):
+    texts = []
+    h = ChapterText(texts.append)
+    rest = ""
+    with io.TextIOWrapper(file.open(chapter), encoding="utf-8") as f:
+      for data in iter(lambda: f.read(CHUNK_SIZE), ""):
+        data = rest + data
+        end = data.rfind(">") + 1
+        h.feed(data[:end])
+        rest = data[end:]
+        yield from texts
+        del texts[:]
+    h.feed(rest)
+    h.close()
+    yield from texts
+
+def textPath(epub):
+  return os.path.join("./books/text/" + ntpath.basename(epub) + ".txt")
+
+def isConverted(epub):
+  output = textPath(epub)
+  return os.path.exists(output) and os.path.getmtime(output) >= os.path.getmtime(epub)
+
+def convertBook(epub):
+  start = time.time()
+  epub2txt(epub).convert()
+  return time.time() - start
 
 if __name__ == "__main__":
     path = './books/raw/'
-    book_files = [f for f in os.listdir(path) if isfile(join(path + f))]
-    book_files = book_files[0:]
-    for book in book_files:
-      try:
-        converter = epub2txt(os.path.join(path + book))
-        print(converter.epub)
-        converter.convert()
-      except:
-        print('convert failed')
+    os.makedirs("./books/text/", exist_ok=True)
+    # Only the epubs, not a download still in progress or anything else kept next to them
+    book_files = sorted([f for f in os.listdir(path) if isfile(join(path + f)) and f.lower().endswith(".epub")])
+    epubs = [os.path.join(path + book) for book in book_files]
+    # A book is only converted again when its epub is newer than its text
+    pending = [epub for epub in epubs if not isConverted(epub)]
+    print("{} books to convert, {} already converted".format(len(pending), len(epubs) - len(pending)))
+
+    start = time.time()
+    failed = []
+    with ProcessPoolExecutor() as executor:
+      futures = {executor.submit(convertBook, epub): epub for epub in pending}
+      for future in as_completed(futures):
+        epub = futures[future]
+        try:
+          print("{:>8.2f}s {}".format(future.result(), epub))
+        except Exception as e:
+          failed.append(epub)
+          print("  failed  {}: {!r}".format(epub, e))
+
+    print("Converted {} books in {:.2f}s, {} failed".format(len(pending) - len(failed), time.time() - start, len(failed)))
+    for epub in failed:
+      print("  {}".format(epub))
+    sys.exit(1 if failed else 0)
 
@@ -1,47 +1,160 @@
 
 # Import libraries
-import shutil
+import argparse
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
 
 import requests
-import urllib.request
-import time
 from bs4 import BeautifulSoup
 
-print('Starting request https://sachvui.com...')
-
-for pageNumber in range(1, 50):
-    print('request page {}'.format(pageNumber))
-    # Set the URL you want to webscrape from
-    url = 'https://sachvui.com/the-loai/tat-ca.html/{}'.format(pageNumber)
-    # url = 'https://sachvui.com/the-loai/van-hoc-viet-nam.html/{}'.format(pageNumber)
-
-    # Connect to the URL
-    response = requests.get(url)
-
-    print('response from page {}'.format(pageNumber))
-    # Parse HTML and save to BeautifulSoup object¶
-    page = BeautifulSoup(response.text, "html.parser")
-    # To download the whole data set, let's do a for loop through all a tags
-    for detail_anchor in page.select('a[href^="https://sachvui.com/ebook/"]'):
-        print('request ebook {}'.format(detail_anchor['href']))
-
-        detail_url = detail_anchor['href']
-        detail_response = requests.get(detail_url)
-        print('response ebook {}'.format(detail_anchor['href']))
-
-        detail = BeautifulSoup(detail_response.text, "html.parser")
-
-        epub_anchor = detail.select_one('a[href^="https://sachvui.com/download/epub/"]')
-        if epub_anchor == None:
-            print('no epub found')
-        else:
-            download_url = epub_anchor['href']
-            print('start download {}'.format(download_url))
-            opener = urllib.request.build_opener()
-            opener.addheaders = [('User-Agent',
-                                  'Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/36.0.1941.0 Safari/537.36')]
-            urllib.request.install_opener(opener)
-            filename = detail_url.split("/")[-1].split('.')[0]
-            urllib.request.urlretrieve(download_url, './books/raw/{}.epub'.format(filename))
-            print('downloaded {}'.format(download_url))
-            time.sleep(1)
\ No newline at end of file
+USER_AGENT = 'Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/36.0.1941.0 Safari/537.36'
+
+
+# Wait so that each host gets at most one request every delay seconds, whichever thread makes it
+class RateLimiter():
+    def __init__(self, delay):
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.next_time = {}
+
+    def wait(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            now = time.time()
+            request_time = max(now, self.next_time.get(host, now))
+            self.next_time[host] = request_time + self.delay
+        time.sleep(max(0, request_time - now))
+
+
+# The ebook pages already crawled, saved after each book so that a rerun skips them.
+# An ebook page maps to the epub file downloaded from it, or to None if it has no epub.
+class Manifest():
+    def __init__(self, manifest_path):
+        self.manifest_path = manifest_path
+        self.lock = threading.Lock()
+        self.books = {}
+        if os.path.exists(manifest_path):
+            with open(manifest_path, encoding='utf_8') as f:
+                self.books = json.load(f)
+
+    def done(self, detail_url):
+        with self.lock:
+            if detail_url not in self.books:
+                return False
+            # A book whose epub was deleted is downloaded again
+            return self.books[detail_url] is None or os.path.exists(self.books[detail_url])
+
+    def add(self, detail_url, epub_path):
+        with self.lock:
+            self.books[detail_url] = epub_path
+            with open(self.manifest_path + '.tmp', 'w', encoding='utf_8') as f:
+                json.dump(self.books, f, ensure_ascii=False, indent=1)
+            os.replace(self.manifest_path + '.tmp', self.manifest_path)
+
+
+class Crawler():
+    def __init__(self, base_url, out_path, manifest_path, workers, delay):
+        self.base_url = base_url.rstrip('/')
+        self.out_path = out_path
+        self.limiter = RateLimiter(delay)
+        # The manifest is kept out of out_path, which holds only the epubs
+        self.manifest = Manifest(manifest_path)
+        # One session for all the threads, keeping a connection open for each of them
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = USER_AGENT
+        adapter = requests.adapters.HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get(self, url, **kwargs):
+        self.limiter.wait(url)
+        response = self.session.get(url, timeout=60, **kwargs)
+        response.raise_for_status()
+        return response
+
+    # The ebook pages linked from a listing page
+    def list_page(self, pageNumber):
+        # Set the URL you want to webscrape from
+        url = '{}/the-loai/tat-ca.html/{}'.format(self.base_url, pageNumber)
+        page = BeautifulSoup(self.get(url).text, "html.parser")
+        return [anchor['href'] for anchor in page.select('a[href^="{}/ebook/"]'.format(self.base_url))]
+
+    def epub_path(self, detail_url):
+        filename = detail_url.split("/")[-1].split('.')[0]
+        return os.path.join(self.out_path, '{}.epub'.format(filename))
+
+    # Download the epub of an ebook page, if it has one
+    def get_book(self, detail_url):
+        detail = BeautifulSoup(self.get(detail_url).text, "html.parser")
+        epub_anchor = detail.select_one('a[href^="{}/download/epub/"]'.format(self.base_url))
+        if epub_anchor is None:
+            self.manifest.add(detail_url, None)
+            return None
+
+        epub_path = self.epub_path(detail_url)
+        # Write to a temporary file first, so an interrupted download is not taken for a book
+        with self.get(epub_anchor['href'], stream=True) as response:
+            with open(epub_path + '.part', 'wb') as f:
+                for chunk in response.iter_content(64 * 1024):
+                    f.write(chunk)
+        os.replace(epub_path + '.part', epub_path)
+        self.manifest.add(detail_url, epub_path)
+        return epub_path
+
+    # Crawl the listing pages and the ebook pages on a pool of threads
+    def crawl(self, pages, executor):
+        downloaded, failed = 0, 0
+        list_futures = [executor.submit(self.list_page, pageNumber) for pageNumber in pages]
+        book_futures = {}
+        seen = set()
+        for future in as_completed(list_futures):
+            try:
+                detail_urls = future.result()
+            except Exception as e:
+                failed += 1
+                print('listing page failed: {!r}'.format(e))
+                continue
+            for detail_url in detail_urls:
+                # Books in the manifest and epubs already downloaded by an earlier run are skipped
+                if detail_url in seen or self.manifest.done(detail_url) or os.path.exists(self.epub_path(detail_url)):
+                    continue
+                seen.add(detail_url)
+                book_futures[executor.submit(self.get_book, detail_url)] = detail_url
+
+        for future in as_completed(book_futures):
+            detail_url = book_futures[future]
+            try:
+                epub_path = future.result()
+            except Exception as e:
+                failed += 1
+                print('failed {}: {!r}'.format(detail_url, e))
+                continue
+            if epub_path is None:
+                print('no epub found {}'.format(detail_url))
+            else:
+                downloaded += 1
+                print('downloaded {}'.format(epub_path))
+        return downloaded, failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Download the epubs of sachvui.com into ./books/raw/')
+    parser.add_argument('--base-url', default='https://sachvui.com')
+    parser.add_argument('--pages', type=int, default=49, help='number of listing pages to crawl')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--delay', type=float, default=0.5, help='seconds between two requests to a host')
+    parser.add_argument('--out', default='./books/raw/')
+    parser.add_argument('--manifest', default='./books/manifest.json', help='record of the ebook pages already crawled')
+    args = parser.parse_args()
+
+    os.makedirs(args.out, exist_ok=True)
+    os.makedirs(os.path.dirname(os.path.abspath(args.manifest)), exist_ok=True)
+    print('Starting request {}...'.format(args.base_url))
+    crawler = Crawler(args.base_url, args.out, args.manifest, args.workers, args.delay)
+    with ThreadPoolExecutor(args.workers) as executor:
+        downloaded, failed = crawler.crawl(range(1, args.pages + 1), executor)
+    print('Downloaded {} books, {} failed'.format(downloaded, failed))